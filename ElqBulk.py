@@ -4,11 +4,27 @@
 # https://pypi.python.org/pypi/pyeloqua/0.5.10
 
 import sqlite3
-from json import dump
+import queue
+import asyncio
+import threading
+import hashlib
+import re
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from json import dump, dumps
+import requests
 from pyeloqua import Bulk, Eloqua
+from pyeloqua.bulk import fields_intersect, EloquaBulkSyncTimeout, POST_HEADERS
+from pyeloqua.pyeloqua import API_VERSION
 import config
 import TableNames
 import time
+import dbutils
+import transport
+import budget
+from ElqCache import ElqCache, cache_key
+from jsonsink import JsonlSink
+from metrics import RunMetrics
 
 __version__ = '0.1.0'
 
@@ -43,21 +59,92 @@ class ElqBulk(object):
         if self.table not in TableNames.tables:
             raise ValueError("Input table name is not within the list of accepted parameters.")
 
-        self.bulk = self._initialize_bulk_()
+        # Column used to find new records when syncing
+        self.date_field = sync_date_field(self.table)
+        self.run_started = kwargs.get('run_started', dbutils.now())
+
+        # Login details and field lists are cached on disk between runs, pass cache=None to always ask Eloqua,
+        # or refresh_fields=True to replace the cached list for this table
+        self.cache = kwargs.get('cache', ElqCache())
+        self.fields_ttl = kwargs.get('fields_ttl', 86400)
+        self.schema_changed = False
+        self.reused_def = False
+        self.unregistered_def = False
+
+        # Interrupted exports are resumed from their checkpoint while Eloqua still holds the synced data,
+        # checkpoint_ttl should not be longer than the export definition's data retention (12 hours by default)
+        self.resume = kwargs.get('resume', True)
+        self.checkpoint_ttl = kwargs.get('checkpoint_ttl', 43200)
+        self.checkpoint = None
+        self.checkpointed = False
+        self.offset = 0
+
+        # Sync submitted to Eloqua and not finished yet, see submit_sync() and wait_sync()
+        self.sync_pending = False
+        self.sync_clock = None
+        self.checkpoint_export = False
+        self.export_start = None
+
+        # Stage timings and counts of rows, bytes and API calls, see metrics.RunMetrics
+        self.metrics = kwargs.get('metrics', RunMetrics('bulk', self.table))
+
+        # The login details are cached with the field lists, only the first job of the day logs in
+        self.login_ttl = kwargs.get('login_ttl', transport.LOGIN_TTL)
+
+        # API calls are rate limited and taken from the daily quota shared with every other job, see budget.Budget
+        self.budget = kwargs.get('budget', budget.shared())
+        self.priority = kwargs.get('priority', 'high')
+
+        with self.metrics.stage('authenticate'):
+            self.bulk = self._initialize_bulk_()
         # self.rest = self._initialize_elq_()
 
-        # _create_DB_columns_def fills self.columns with all necessary column information
-        self.columns = self._create_db_columns_def_()
-
-        self.db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        self.db.row_factory = sqlite3.Row
+        # _load_schema_ fills self.fields with the available fields and self.columns
+        # with all necessary column information
+        self.fields, self.columns = self._load_schema_(kwargs.get('refresh_fields', False))
+        self.key = dbutils.primary_key(self.columns)
+
+        # Type converters for each column layout seen in the export, see prepare_rows()
+        self.converters = {}
+
+        # Fast loads use WAL and a staging table merged with a single upsert, instead of INSERT OR REPLACE.
+        # The staging table only pays off when records already exist: a table that is empty when
+        # create_table() runs is loaded with plain inserts, see upsert()
+        self.fast_load = kwargs.get('fast_load', False) and self.key is not None
+        self.empty_table = False
+
+        # Concurrent syncs hand their records to a single writer instead of opening a connection
+        if kwargs.get('connect', True):
+            self.db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            self.db.row_factory = sqlite3.Row
+            if self.fast_load:
+                dbutils.tune_for_load(self.db)
+        else:
+            self.db = None
 
     def _initialize_bulk_(self):
         """
         Initialize Bulk class
         """
 
-        bulk = Bulk(username=self.username, password=self.password, company=self.company)
+        login = transport.login(self.company, self.username, self.password, cache=self.cache, ttl=self.login_ttl,
+                                metrics=self.metrics, budget=self.budget)
+
+        # Set up Bulk without its own login request, from the discovered urls
+        bulk = Bulk(test=True)
+        bulk.username = self.username
+        bulk.password = self.password
+        bulk.company = self.company
+        bulk.auth = (self.company + '\\' + self.username, self.password)
+        bulk.userId = bulk.user_id = login['user']['id']
+        bulk.userDisplay = bulk.user_display = login['user']['displayName']
+        bulk.urlBase = bulk.url_base = login['urls']['base']
+        bulk.siteId = bulk.site_id = login['site']['id']
+        bulk.rest_bs_un = login['urls']['apis']['rest']['standard']
+        bulk.restBase = bulk.rest_base = bulk.rest_bs_un.format(version=API_VERSION)
+        bulk.bulk_bs_un = login['urls']['apis']['rest']['bulk']
+        bulk.bulkBase = bulk.bulk_base = bulk.bulk_bs_un.format(version=API_VERSION)
+
         print("-" * 50)
         print("Initialized connection to Eloqua")
         print("Beginning {} sync.".format(self.table))
@@ -98,15 +185,73 @@ class ElqBulk(object):
         elq.GetAsset(assetType='activity', assetId=None)
         return elq
 
-    def _create_db_columns_def_(self):
+    def _api_call_(self):
         """
-        Create a dictionary of column definitions from the list of fields returned by Eloqua
+        Take an API call from the budget, waiting for the rate limit, and count it
+        """
+
+        self.budget.spend(self.priority)
+        self.metrics.count('api_calls')
+
+    def _load_schema_(self, refresh=False):
+        """
+        Load the list of available fields and the column definitions derived from it,
+        from the cache if the cached copy is younger than fields_ttl, otherwise from Eloqua
+        :param refresh: ignore the cached copy and ask Eloqua
+        :return: list of fields, dictionary of column definitions
         """
 
+        key = cache_key('fields', self.company, self.table)
+
+        if self.cache is not None and not refresh:
+            cached = self.cache.get(key, ttl=self.fields_ttl)
+            if cached is not None:
+                print("Loaded list of available columns from cache.")
+                return cached['fields'], cached['columns']
+
         print("Loading list of available columns to create table...")
-        fields = self.bulk.get_fields()  # This will give us a list of the available fields and their names
-        # print("@"*50)
-        # print(fields)
+        with self.metrics.stage('get_fields'):
+            if self.bulk.job['elq_object'] != 'activities':
+                self._api_call_()
+            fields = self.bulk.get_fields()  # This will give us a list of the available fields and their names
+        columns = self._create_db_columns_def_(fields)
+
+        if self.cache is not None:
+            previous = self.cache.peek(key)
+            if previous is not None:
+                self.schema_changed = self._compare_columns_(previous['value']['columns'], columns)
+            self.cache.set(key, {'fields': fields, 'columns': columns})
+
+        return fields, columns
+
+    def _compare_columns_(self, old, new):
+        """
+        Report the differences between the cached column definitions and the current ones
+        :return: True if the schema has changed
+        """
+
+        added = [k for k in new if k not in old]
+        removed = [k for k in old if k not in new]
+        retyped = [k for k in new if k in old and new[k] != old[k]]
+
+        if not (added or removed or retyped):
+            return False
+
+        print("Schema of {} has changed in Eloqua.".format(self.table))
+        if added:
+            print("New columns: {}".format(added))
+        if removed:
+            print("Removed columns: {}".format(removed))
+        if retyped:
+            print("Columns with a new data type: {}".format(retyped))
+
+        return True
+
+    def _create_db_columns_def_(self, fields):
+        """
+        Create a dictionary of column definitions from the list of fields returned by Eloqua
+        :param fields: list of fields returned by bulk.get_fields()
+        """
 
         # Extract values from nested dictionaries with key = 'internalName' or 'name'
         # and append it into the list 'column'
@@ -153,154 +298,627 @@ class ElqBulk(object):
     # Helper Methods
     # ------------------------------------------------------------------------------------------
 
-    def create_table(self):
+    def create_table_sql(self):
+        """
+        SQL statement that creates the table for this export if it does not exist yet
+        """
+
+        col = ', '.join("'{}' {}".format(key, val) for key, val in self.columns.items())
+
+        return '''CREATE TABLE IF NOT EXISTS {}
+                            ({})'''.format(self.table, col)
+
+    def insert_sql(self, col):
+        """
+        SQL statement that inserts or replaces one record in the table
+        :param col: list of column names, in the same order as the values in each row
+        """
+
+        return """INSERT OR REPLACE INTO {} {} VALUES ({})""".format(
+            self.table, tuple(col), ",".join("?" * len(col)))
+
+    def create_table(self, db=None):
         """
         Creates a SQL database file if one does not yet exist, and a table if one does not
-        yet exist to dump active data into.
+        yet exist to dump active data into, along with its indexes and the sync_state table.
+        If the table exists, any new Eloqua field is added to it as a new column.
         Also initiates row_factory to allow ElsDB to write to the table
+        :param db: connection to create the table with, defaults to this instance's connection
         """
 
-        col = ', '.join("'{}' {}".format(key, val) for key, val in self.columns.items())
+        if db is None:
+            db = self.db
+
+        db.execute(self.create_table_sql())
+        dbutils.evolve_schema(db, self.table, self.columns)
 
-        self.db.execute('''CREATE TABLE IF NOT EXISTS {}
-                            ({})'''.format(self.table, col))
+        for sql in dbutils.index_sql(self.table, self.columns):
+            db.execute(sql)
 
-    def get_initial_data(self):
+        dbutils.create_sync_state(db)
+
+        self.empty_table = db.execute("""SELECT 1 FROM {} LIMIT 1""".format(self.table)).fetchone() is None
+
+    def upsert(self):
         """
-        PyEloqua initial data pull
+        True if rows are merged through the staging table, False if they are written with INSERT OR REPLACE:
+        a fast load into a table that was empty when create_table() ran has nothing to merge with
         """
+        return self.fast_load and not self.empty_table
 
-        # -----------------------------------------------------------
-        # CREATING DEFINITION FOR EXPORT FROM ELOQUA
+    def last_date(self, records, latest=None):
+        """
+        Latest updatedAt or ActivityDate of a batch of records
+        :param latest: latest date of the batches loaded before, kept if it is later
+        :return: datetime, None if no record has a date
+        """
 
-        print("Loading list of available data...")
-        fields = self.bulk.get_fields()  # This will give us a list of the available fields and their names
+        found = dbutils.to_datetime(dbutils.max_value(records, self.date_field))
+        dates = [d for d in (latest, found) if d is not None]
 
-        # Extract values from nested dictionaries with key = 'name'
-        # and append it into the list 'fieldlist'
-        _col = []
-        for record in fields:
-            _col.append(record['name'])
+        return max(dates) if len(dates) != 0 else None
 
-        print("\n {} \n".format(_col))
+    def record_sync_state(self, watermark, rows, db=None):
+        """
+        Record a loaded export in sync_state, in the same transaction as its last records.
+        Only record it once every record of the export is written: the watermark never moves back,
+        so recording it part way through would skip the rest of the export if the load then failed.
+        :param watermark: latest date of the export, see last_date()
+        :param rows: number of records loaded
+        :param db: connection or DbWriter the records were written with, defaults to this instance's connection
+        """
 
-        # Add the fields dump as the export list to get all fields
-        self.bulk.add_fields(_col)
+        if db is None:
+            db = self.db
 
-        # END FIELD DEFINITION
-        # -----------------------------------------------------------
+        dbutils.update_sync_state(db, self.table, watermark, rows, self.run_started)
 
-        print("Sending Export definition to Eloqua...")
-        self.bulk.create_def('Bulk Export - {}'.format(self.table))  # send export info to Eloqua
+    def prepare_rows(self, records):
+        """
+        Turn a batch of exported records into rows of values converted to the declared column types,
+        so dates are stored as dates and numbers as numbers rather than as the text Eloqua returns
+        :param records: list of records from the export
+        :return: list of column names, list of rows
+        """
 
-        print("Loading Eloqua data to instance. This may take a while...")
-        self.bulk.sync()
+        col = list(records[0].keys())
 
-        # Now export individual rows
-        self.data = self.bulk.get_export_data()
+        convert = self.converters.get(tuple(col))
+        if convert is None:
+            convert = self.converters[tuple(col)] = dbutils.batch_converter(self.columns, col)
 
-        # Print a divider line and the first record of data
-        print("\n" + '#' * 50 + "\n")
-        print("First record in export:" + "\n")
-        print(self.data[0])
+        return col, convert([list(d.values()) for d in records])
 
-        _count = self.bulk.get_export_count()
-        print("\n" + '#' * 50 + "\n")
-        print("Count of {} records in Eloqua: {}".format(self.table, _count))
+    def _sync_start_(self):
+        """
+        Find the last date in updatedAt or ActivityDate for this table
+        :return: last date in the table, None if the table is empty
+        """
+
+        try:
+            return last_sync_date(self.db, self.table)
+        except sqlite3.OperationalError:
+            print("ERROR: You must create a table before you can sync to it.\nTry create_table().")
+        except AttributeError:
+            print("ERROR: You must initialize your SQL connection before"
+                  " you can sync to it.\nUse initiate_sql() first, or get"
+                  "_initial_data() if you just want to pull data to work with.")
+            exit()
 
-        print("Finished loading {} activity data.".format(self.table))
+        return None
 
-        return self.data
+    def _add_fields_(self):
+        """
+        Add every available field to the export definition
+        """
+
+        print("Exporting {} fields.".format(len(self.fields)))
 
-    def get_sync_data(self):
+        # bulk.add_fields() would call get_fields() again just to look these names up,
+        # the field objects loaded with the schema are exactly what it adds to the job
+        self.bulk.job['fields'].extend(self.fields)
+
+    def _filter_date_(self, start=None, end=None):
         """
-        PyEloqua initial data pull
-        Will always retrieve at least 1 record.
+        Add a filter on the table's date field, the same filter bulk.filter_date() builds.
+        bulk.filter_date() calls get_fields() again only to find the field statement,
+        which is already in the cached field objects.
+        :param start: datetime or 'YYYY-MM-DD HH:MM:SS' string for date >=
+        :param end: datetime or 'YYYY-MM-DD HH:MM:SS' string for date <, the end is left out so that
+                    consecutive windows, each starting where the last one ended, never export a record twice
         """
 
-        # -----------------------------------------------------------
-        # CREATING DEFINITION FOR EXPORT FROM ELOQUA
+        statement = fields_intersect(self.fields, [self.date_field])[0]['statement']
 
-        print("Loading list of available data...")
-        fields = self.bulk.get_fields()  # This will give us a list of the available fields and their names
+        filters = []
+        if start is not None:
+            filters.append(" '{}' >= '{}' ".format(statement, _filter_value_(start)))
+        if end is not None:
+            filters.append(" '{}' < '{}' ".format(statement, _filter_value_(end)))
 
-        # Extract values from nested dictionaries with key = 'name'
-        # and append it into the list 'fieldlist'
-        _col = []
-        for record in fields:
-            _col.append(record['name'])
+        self.bulk.job['filters'].append('AND'.join(filters))
 
-        print("\n {} \n".format(_col))
+    def _definition_key_(self):
+        """
+        Registry key of the current export definition: the table, a hash of its fields,
+        and the shape of its filter (the filter with its dates left out)
+        """
 
-        # Add the fields dump as the export list to get all fields
-        self.bulk.add_fields(_col)
+        # Activity fields have no internalName, their name is what the export uses
+        fields = dumps(sorted(f.get('internalName', f['name']) for f in self.fields))
+        filters = dumps(self.bulk.job['filters'], default=str)
+        shape = re.sub(r"\d{4}-\d{2}-\d{2}[^'\"]*", '?', filters)
 
-        # Section to filter data pulled from eloqua to new information only
+        return cache_key('exports', self.company, self.table,
+                         hashlib.sha1(fields.encode()).hexdigest()[:12],
+                         hashlib.sha1(shape.encode()).hexdigest()[:12]), filters
 
-        if self.table == "contacts":
-            date_field = "updatedAt"
-        elif self.table == "accounts":
-            date_field = "updatedAt"
-        else:
-            date_field = "ActivityDate"
+    def _create_def_(self, register=True):
+        """
+        Send the export definition to Eloqua, unless a definition with the same fields and filter shape
+        is registered in the cache, in which case it is reused and only a new sync is started.
+        Incremental filters carry the last sync date, which changes with every run: the registered definition's
+        filter is then updated in place, Eloqua's syncs can't be given a filter of their own.
+        :param register: look up and register the definition, False always creates an unregistered one
+        """
+
+        self.reused_def = False
+        name = 'Bulk Export - {}'.format(self.table)
+
+        if self.cache is None or not register:
+            self._send_def_(name)
+            self.unregistered_def = True
+            return
+
+        key, filters = self._definition_key_()
+        registered = self.cache.get(key)
+
+        if registered is not None and (registered['filter'] == filters or self._update_def_(registered['uri'], name)):
+            print("Reusing registered export definition {}.".format(registered['uri']))
+            self.bulk.job_def = {'name': name, 'uri': registered['uri']}
+            self.reused_def = True
+            if registered['filter'] != filters:
+                self.cache.set(key, {'uri': registered['uri'], 'filter': filters})
+            return
+
+        self._send_def_(name)
+        self.cache.set(key, {'uri': self.bulk.job_def['uri'], 'filter': filters})
+
+    def _send_def_(self, name):
+        """
+        Create the export definition in Eloqua
+        """
+
+        with self.metrics.stage('create_def'):
+            self._api_call_()
+            self.bulk.create_def(name)
+
+    def delete_def(self):
+        """
+        Delete an export definition that was not registered from Eloqua, e.g. a date window's once it is loaded,
+        nothing reuses it. Registered definitions are kept.
+        """
+
+        if not self.unregistered_def:
+            return
+
+        uri = self.bulk.job_def['uri']
+        self._api_call_()
+        req = requests.delete(self.bulk.bulk_base + uri, auth=self.bulk.auth)
+        self.unregistered_def = False
+
+        if req.status_code not in (200, 204, 404):
+            print("Could not remove export definition {}, Error Code: {}".format(uri, req.status_code))
+
+    def _update_def_(self, uri, name):
+        """
+        Replace the filter of a registered export definition with the current one, its fields are unchanged
+        :return: True if Eloqua updated the definition, False if it has to be created again
+        """
+
+        body = {'name': name, 'fields': {}, 'filter': 'AND'.join(self.bulk.job['filters'])}
+        # Same field names as bulk.create_def() sends
+        for field in self.bulk.job['fields']:
+            body['fields'][field.get('internalName', field['name'])] = field['statement']
+        body.update(self.bulk.job['options'] or {})
+
+        with self.metrics.stage('update_def'):
+            self._api_call_()
+            req = requests.put(self.bulk.bulk_base + uri, auth=self.bulk.auth, headers=POST_HEADERS,
+                               data=dumps(body, ensure_ascii=False).encode('utf8'))
+
+        if req.status_code != 200:
+            print("Could not update registered export definition {}, Error Code: {}".format(uri, req.status_code))
+            return False
+
+        return True
+
+    def _start_sync_(self):
+        """
+        Start a sync of the export definition in Eloqua, without waiting for it to finish.
+        If a reused definition was deleted on Eloqua's side, a new one is created and registered instead.
+        """
 
-        # Find the last date in updatedAt or ActivityDate
         try:
-            c = self.db.cursor()
+            self._post_sync_()
+        except Exception as e:
+            if not self.reused_def:
+                raise
+            print("Registered export definition could not be synced ({}), creating a new one.".format(e))
+            self.cache.invalidate(self._definition_key_()[0])
+            self._create_def_()
+            self._post_sync_()
+
+        self.sync_pending = True
+        self.sync_clock = time.perf_counter()
+
+    def _post_sync_(self):
+        """
+        Ask Eloqua to sync the export definition
+        """
 
-            try:
-                c.execute(
-                    """SELECT {} AS "{} [timestamp]" FROM {} ORDER BY {} DESC LIMIT 1;""".format(
-                        date_field, date_field, self.table, date_field))
-            except sqlite3.OperationalError:
-                print("ERROR: You must create a table before you can sync to it.\nTry create_table().")
+        self._api_call_()
+        self.bulk.start_sync()
+
+        if 'uri' not in self.bulk.job_sync:
+            raise Exception("Eloqua did not start the sync: {}".format(self.bulk.job_sync))
+
+    def _check_sync_(self):
+        """
+        Ask Eloqua once whether the sync has finished
+        """
+
+        self._api_call_()
+        finished = self.bulk.check_sync()
+
+        return finished
+
+    def _sync_finished_(self):
+        """
+        Record the finished sync, and checkpoint it if the export is checkpointed
+        """
+
+        self.sync_pending = False
+        self.metrics.add_time('sync', time.perf_counter() - self.sync_clock)
+        print("Eloqua finished the {} sync with status: {}".format(self.table, self.bulk.job_sync['status']))
+
+        if self.checkpoint_export:
+            self._save_checkpoint_(self.export_start)
+
+    def wait_sync(self, timeout=600, interval=1, max_interval=30, backoff=1.5):
+        """
+        Wait for Eloqua to finish the submitted sync. The status is checked often at first,
+        then less and less often, so long exports do not use up API calls.
+        :param timeout: seconds to wait before giving up
+        :param interval: seconds before the second status check
+        :param max_interval: longest wait between status checks
+        :param backoff: factor the wait grows by after every check
+        :return: final status of the sync
+        """
+
+        if self.sync_pending:
+            delays = _poll_delays_(interval, max_interval, backoff)
+            waited = 0
+            while not self._check_sync_():
+                if waited >= timeout:
+                    raise EloquaBulkSyncTimeout('sync not finished after {} seconds'.format(waited))
+                delay = next(delays)
+                time.sleep(delay)
+                waited += delay
 
+            self._sync_finished_()
+
+        return self.bulk.job_sync.get('status')
+
+    async def wait_sync_async(self, timeout=600, interval=1, max_interval=30, backoff=1.5):
+        """
+        Coroutine version of wait_sync(), the status checks run in the event loop's executor
+        so any number of syncs can be polled at the same time, see run_syncs()
+        """
+
+        loop = asyncio.get_running_loop()
+
+        if self.sync_pending:
+            delays = _poll_delays_(interval, max_interval, backoff)
+            waited = 0
+            while not await loop.run_in_executor(None, self._check_sync_):
+                if waited >= timeout:
+                    raise EloquaBulkSyncTimeout('sync not finished after {} seconds'.format(waited))
+                delay = next(delays)
+                await asyncio.sleep(delay)
+                waited += delay
+
+            self._sync_finished_()
+
+        return self.bulk.job_sync.get('status')
+
+    def _resume_(self):
+        """
+        Look for the checkpoint of an interrupted export of this table. If Eloqua still holds its synced data,
+        the export definition, sync and download offset are restored so the export carries on where it stopped.
+        An expired checkpoint is kept in self.checkpoint, so a new export can start from the same date.
+        :return: True if the interrupted export was resumed
+        """
+
+        if self.db is None or not self.resume:
+            return False
+
+        self.checkpoint = dbutils.get_checkpoint(self.db, self.table)
+        if self.checkpoint is None:
+            return False
+
+        age = (dbutils.now() - self.checkpoint['synced_at']).total_seconds()
+        if age < self.checkpoint_ttl:
+            self._api_call_()
             try:
-                max_update = c.fetchone()[0]
-                self.bulk.filter_date(field=date_field, start=max_update)
-                print("Extracting everything after: {}".format(max_update))
-            except TypeError:
-                print("There is no pre-existing data in this table.")
+                valid = self.bulk.check_sync(self.checkpoint['sync_uri']) and \
+                    self.bulk.job_sync['status'] in ('success', 'warning')
+            except Exception as e:
+                print("Could not check the interrupted {} export: {}".format(self.table, e))
+                valid = False
+        else:
+            valid = False
 
-        except AttributeError:
-            print("ERROR: You must initialize your SQL connection before"
-                  " you can sync to it.\nUse initiate_sql() first, or get"
-                  "_initial_data() if you just want to pull data to work with.")
-            exit()
+        if not valid:
+            print("The interrupted {} export has expired in Eloqua, starting a new export.".format(self.table))
+            return False
 
-        # Grab the latest date from the SQLite Database for the specified table
+        self.bulk.job_def = {'name': 'Bulk Export - {}'.format(self.table), 'uri': self.checkpoint['def_uri']}
+        self.offset = self.checkpoint['download_offset']
+        self.checkpointed = True
+        print("Resuming the interrupted {} export {} from record {}, {} batches were already committed.".format(
+            self.table, self.checkpoint['sync_uri'], self.offset, self.checkpoint['committed_batches']))
+
+        return True
+
+    def _save_checkpoint_(self, start):
+        """
+        Record the finished Eloqua sync, so the download can be resumed if this run is interrupted
+        :param start: date the export was filtered from, None for a full export
+        """
+
+        if self.db is None or not self.resume:
+            return
+
+        if self.bulk.job_sync.get('status') not in ('success', 'warning'):
+            return
+
+        dbutils.save_checkpoint(self.db, self.table, def_uri=self.bulk.job_def['uri'],
+                                sync_uri=self.bulk.job_sync['uri'], start=_filter_value_(start),
+                                synced_at=dbutils.now(), download_offset=0, committed_batches=0, latest=None)
+        self.db.commit()
+        self.checkpoint = None
+        self.checkpointed = True
+        self.offset = 0
+
+    def _update_checkpoint_(self, offset, batches, latest=None):
+        """
+        Record how far the download has got, run it before the commit of the records it describes
+        :param latest: latest date of the records committed so far, see last_date()
+        """
+
+        if self.checkpointed:
+            dbutils.update_checkpoint(self.db, self.table, offset, batches, latest)
+
+    def _loaded_before_(self):
+        """
+        Records committed by the interrupted run of a resumed export, so the whole export is recorded in sync_state
+        :return: (number of records, latest date of those records or None)
+        """
+
+        if self.checkpointed and self.checkpoint is not None:
+            return self.offset, self.checkpoint.get('latest')
+
+        return 0, None
+
+    def _discard_checkpoint_(self):
+        """
+        Remove the checkpoint of an interrupted export before an export from an explicit start date,
+        which is never resumed from it
+        """
 
-        # Add filter to selected date column by last date in system
+        if self.db is None:
+            return
+
+        dbutils.clear_checkpoint(self.db, self.table)
+        self.db.commit()
+        self.checkpoint = None
+        self.checkpointed = False
+        self.offset = 0
+
+    def _clear_checkpoint_(self):
+        """
+        Remove the checkpoint once every record of the export is loaded, committed with the last records.
+        Any checkpoint of the table is removed, e.g. one left by an interrupted run when resume=False.
+        """
+
+        dbutils.clear_checkpoint(self.db, self.table)
+        self.checkpoint = None
+        self.checkpointed = False
+        self.offset = 0
+
+    def _export_count_(self):
+        """
+        Number of records in the finished export
+        """
+
+        self._api_call_()
+        return self.bulk.get_export_count()
+
+    def _download_(self):
+        """
+        Download the whole export into memory
+        :return: list of records
+        """
+
+        with self.metrics.stage('download'):
+            return [record for page in self.iter_export_data(offset=self.offset) for record in page]
+
+    def _data_uri_(self):
+        """
+        Endpoint of the exported data, the data of the sync itself when it is known,
+        so a resumed download reads the same records even if the definition was synced again since
+        """
+
+        if self.bulk.job_sync.get('uri') is not None:
+            return self.bulk.job_sync['uri'] + '/data'
+
+        return self.bulk.job_def['uri'] + '/data'
+
+    def submit_initial(self, start=None, end=None):
+        """
+        Send the export definition of an initial data pull to Eloqua and start its sync, without waiting for it.
+        Follow with wait_sync() and fetch_export(), or use get_initial_data() to do all three.
+        :param start: only export records with a date from start onwards
+        :param end: only export records with a date before end
+        """
+
+        # -----------------------------------------------------------
+        # CREATING DEFINITION FOR EXPORT FROM ELOQUA
+
+        # Add the fields dump as the export list to get all fields
+        self._add_fields_()
+
+        # Restrict the export to a window of updatedAt or ActivityDate, used by partitioned loads
+        whole = start is None and end is None
+        if not whole:
+            self._filter_date_(start=start, end=end)
+            print("Extracting from {} to {}.".format(start, end))
 
         # END FIELD DEFINITION
         # -----------------------------------------------------------
 
+        # Date windows are not checkpointed, an interrupted window is simply exported again
+        if whole and self._resume_():
+            return
+        if not whole:
+            self._discard_checkpoint_()
+
         print("Sending Export definition to Eloqua...")
-        self.bulk.create_def('Bulk Export - {}'.format(self.table))  # send export definition to Eloqua
+        # send export info to Eloqua, date windows get a definition of their own
+        self._create_def_(register=whole)
+
+        print("Starting the {} sync in Eloqua. This may take a while...".format(self.table))
+        self.checkpoint_export = whole
+        self.export_start = None
+        self._start_sync_()
 
-        print("Finished loading {} activity data.".format(self.table))
+    def submit_sync(self, **kwargs):
+        """
+        Send the export definition of a sync to Eloqua and start its sync, without waiting for it.
+        Follow with wait_sync() and fetch_export(), or use get_sync_data() to do all three.
+        :param start: date to extract from, if not provided the last date in the table is used
+                      (None extracts everything)
+        """
 
-        print("Loading Eloqua data to instance. This may take a while...")
-        self.bulk.sync()
+        # -----------------------------------------------------------
+        # CREATING DEFINITION FOR EXPORT FROM ELOQUA
 
-        # Now export individual rows
-        self.data = self.bulk.get_export_data()
+        # Add the fields dump as the export list to get all fields
+        self._add_fields_()
+
+        # Section to filter data pulled from eloqua to new information only
+        # Find the last date in updatedAt or ActivityDate, unless a start date was provided
+
+        # An interrupted sync is resumed, unless a different start date was asked for
+        if 'start' not in kwargs and self._resume_():
+            return
+        if 'start' in kwargs:
+            self._discard_checkpoint_()
+
+        if 'start' in kwargs:
+            max_update = kwargs['start']
+        elif self.checkpoint is not None:
+            # The interrupted sync expired before it finished, it is exported again from where it started
+            max_update = self.checkpoint['start']
+        else:
+            max_update = self._sync_start_()
+
+        if max_update is not None:
+            self._filter_date_(start=max_update)
+            print("Extracting everything after: {}".format(max_update))
+        else:
+            print("There is no pre-existing data in this table.")
+
+        # END FIELD DEFINITION
+        # -----------------------------------------------------------
+
+        print("Sending Export definition to Eloqua...")
+        self._create_def_()  # send export definition to Eloqua, or reuse the registered one
+
+        print("Starting the {} sync in Eloqua. This may take a while...".format(self.table))
+        self.checkpoint_export = 'start' not in kwargs
+        self.export_start = max_update
+        self._start_sync_()
+
+    def fetch_export(self, stream=False):
+        """
+        Get the data of the finished sync
+        :param stream: if True, only count the records, they are then downloaded
+                       page by page with iter_export_data() or stream_to_database()
+        :return: list of records, None when streaming
+        """
 
-        # Print a divider line and the first record of data
-        print("\n" + '#' * 50 + "\n")
-        print("First record in export:" + "\n")
-        print(self.data[0])
+        _count = self._export_count_()
 
-        _count = self.bulk.get_export_count()
-        print("\n" + '#' * 50 + "\n")
-        print("Count of new {} records in Eloqua: {}".format(self.table, _count))
+        if stream:
+            print("Count of {} records ready to stream from Eloqua: {}".format(self.table, _count))
+            self.data = None
+            return self.data
+
+        # Now export individual rows
+        self.data = self._download_()
+
+        print("Count of {} records in Eloqua: {}".format(self.table, _count))
 
         return self.data
 
-    def dump_to_json(self):
+    def get_initial_data(self, stream=False, start=None, end=None):
+        """
+        PyEloqua initial data pull
+        :param stream: if True, only prepare and run the export, the records are then
+                       downloaded page by page with iter_export_data() or stream_to_database()
+        :param start: only export records with a date from start onwards
+        :param end: only export records with a date before end
+        """
+
+        self.submit_initial(start=start, end=end)
+        self.wait_sync()
+
+        return self.fetch_export(stream)
+
+    def get_sync_data(self, stream=False, **kwargs):
+        """
+        PyEloqua sync data pull, only records changed since the last sync
+        Will always retrieve at least 1 record.
+        :param stream: if True, only prepare and run the export, the records are then
+                       downloaded page by page with iter_export_data() or stream_to_database()
+        :param start: date to extract from, if not provided the last date in the table is used
+                      (None extracts everything)
+        """
+
+        self.submit_sync(**kwargs)
+        self.wait_sync()
+
+        return self.fetch_export(stream)
+
+    def dump_to_json(self, jsonl=False, compression=None, max_bytes=None, limit=50000):
         """
         Dump current export data into a json file
+        :param jsonl: write newline-delimited JSON, one record per line, page by page as the export streams in,
+                      see jsonsink.JsonlSink
+        :param compression: JSON Lines only, None, 'gzip' or 'zstd'
+        :param max_bytes: JSON Lines only, start a new numbered file once a file reaches this size
+        :param limit: JSON Lines only, number of records per page requested from Eloqua
         """
+
+        if jsonl:
+            with JsonlSink('bulk_export_{}'.format(self.table), compression=compression,
+                           max_bytes=max_bytes) as sink:
+                for page in self._iter_pages_(limit):
+                    sink.write_many(page)
+            return sink.records
+
         try:
             with open('bulk_export_{}.json'.format(self.table), 'w') as fopen:
                 dump(self.data, fopen, indent=3)
@@ -309,6 +927,182 @@ class ElqBulk(object):
                   'to grab data from Eloqua before dumping to a file.')
             exit()
 
+    def dump_to_parquet(self, filename=None, fmt='parquet', compression=None, limit=50000):
+        """
+        Write the export to a columnar Parquet or Arrow IPC file as it streams in, one row group per page,
+        compressed and typed after the table's column definitions, so a single column can be read
+        without loading the rest of the file. Requires pyarrow.
+        :param filename: name of the file, defaults to bulk_export_<table>.parquet or .arrow
+        :param fmt: 'parquet' or 'arrow'
+        :param compression: codec, defaults to snappy for Parquet and zstd for Arrow
+        :param limit: number of records per page requested from Eloqua, and per row group
+        :return: number of records written
+        """
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print('ERROR: pyarrow must be installed to dump to Parquet or Arrow files.')
+            exit()
+
+        if fmt not in ('parquet', 'arrow'):
+            raise ValueError("fmt must be 'parquet' or 'arrow'.")
+
+        if filename is None:
+            filename = 'bulk_export_{}.{}'.format(self.table, fmt)
+
+        # Eloqua number fields are INTEGER columns but may hold decimals, float64 keeps both
+        arrow_types = {dbutils.to_int: pa.float64(), dbutils.to_float: pa.float64(),
+                       dbutils.to_datetime: pa.timestamp('ms')}
+        names = list(self.columns.keys())
+        converters = [dbutils.converter_for(self.columns[key]) for key in names]
+        schema = pa.schema([(key, arrow_types.get(fn, pa.string())) for key, fn in zip(names, converters)])
+
+        if fmt == 'parquet':
+            writer = pq.ParquetWriter(filename, schema, compression=compression or 'snappy')
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=compression or 'zstd')
+            writer = pa.ipc.new_file(filename, schema, options=options)
+
+        total = 0
+        nulled = 0
+        try:
+            for page in self._iter_pages_(limit):
+                arrays = []
+                for key, fn, field in zip(names, converters, schema):
+                    values = [d.get(key) for d in page]
+                    if fn is not None:
+                        values, bad = _arrow_values_(values, fn)
+                        nulled += bad
+                    arrays.append(pa.array(values, type=field.type))
+
+                batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+                if fmt == 'parquet':
+                    writer.write_table(pa.Table.from_batches([batch]))
+                else:
+                    writer.write_batch(batch)
+                total += len(page)
+        finally:
+            writer.close()
+
+        if nulled:
+            print("{} values of {} could not be converted and were written as null.".format(nulled, self.table))
+        print("Wrote {} {} records to {}.".format(total, self.table, filename))
+
+        return total
+
+    def _iter_pages_(self, limit=50000):
+        """
+        Pages of the current export: slices of self.data if it was downloaded, otherwise streamed from Eloqua
+        """
+
+        if self.data is not None:
+            for i in range(0, len(self.data), limit):
+                yield self.data[i:i + limit]
+        else:
+            for page in self.iter_export_data(limit=limit):
+                if len(page) != 0:
+                    yield page
+
+    def iter_export_data(self, limit=50000, prefetch=2, offset=0):
+        """
+        Generator that yields the export data one page at a time instead of loading it all at once.
+        Pages are downloaded on a background thread, so the next page is already on its way
+        while the current one is being written to the database.
+        :param limit: number of records per page requested from Eloqua (50000 max)
+        :param prefetch: number of downloaded pages allowed to wait in memory
+        :param offset: number of records to skip, used to resume an interrupted download
+        """
+
+        try:
+            url = self.bulk.bulk_base + self._data_uri_()
+        except KeyError:
+            print('ERROR: You must use get_initial_data() or get_sync_data() '
+                  'to create an export in Eloqua before streaming from it.')
+            exit()
+
+        pages = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            """
+            Local function that hands a page to the consumer, gives up if the consumer stopped
+            """
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def download():
+            """
+            Local function that pages through the export until Eloqua reports no more data
+            """
+            position = offset
+            try:
+                while True:
+                    self._api_call_()
+                    req = requests.get(url, params={'offset': position, 'limit': limit}, auth=self.bulk.auth)
+                    self.metrics.count('bytes', len(req.content))
+                    req.raise_for_status()
+                    page = req.json()
+                    if not put(page.get('items', [])):
+                        return
+                    if not page.get('hasMore', False):
+                        break
+                    position += limit
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        worker = threading.Thread(target=download, name='{}-download'.format(self.table), daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+
+    def _insert_rows_(self, col, sql_data, x=1):
+        """
+        Insert rows into the table, allows a wait period if database file is busy, then retries
+        :param col: list of column names, in the same order as the values in each row
+        :param sql_data: list of rows to insert
+        :param x: current try
+        """
+
+        try:
+            if self.upsert():
+                dbutils.upsert_rows(self.db, self.table, col, sql_data, self.key)
+            else:
+                self.db.executemany(self.insert_sql(col), sql_data)
+        except AttributeError:
+            print('ERROR: You must create a table before loading to it. Try initiate_table().')
+        except sqlite3.OperationalError as e:
+            if dbutils.missing_column(e) and x == 1:
+                # Add the missing columns to the table in place, then try once more
+                columns = dict(self.columns)
+                columns.update({key: 'TEXT' for key in col if key not in columns})
+                dbutils.evolve_schema(self.db, self.table, columns)
+                self._insert_rows_(col, sql_data, x + 1)
+            elif x == 5:
+                print("ERROR: {}\n Could not load data into {} after 5 tries.".format(e, self.table))
+                raise
+            else:
+                print("ERROR: {}\n Waiting 15 seconds then trying again.\nTry {} out of 5".format(e, x))
+                time.sleep(15)
+                self._insert_rows_(col, sql_data, x + 1)
+
     def load_to_database(self):
         """
         Load contacts to appropriate database table
@@ -318,42 +1112,19 @@ class ElqBulk(object):
         print('Processing data for SQL database...')
 
         try:
-            col = list(self.data[0].keys())
+            col, sql_data = self.prepare_rows(self.data)
 
             col_count = len(col)
 
             print("This table contains {} columns.".format(col_count))
 
-            sql_data = []
-            for d in self.data:
-                sql_data.append(list(d.values()))
-
-            # Initialize database connection, if database is locked, waits 1 minute, then retries
-
-            def insert_data(x=1):
-                """
-                Local function that allows a wait period if database file is busy, then retries
-                """
-                try:                  
-                    self.db.executemany("""INSERT OR REPLACE INTO {} {} VALUES ({})""".format(
-                        self.table, tuple(col), ",".join("?" * col_count)), sql_data)
-                except AttributeError:
-                    print('ERROR: You must create a table before loading to it. Try initiate_table().')
-                except sqlite3.OperationalError as e:
-                    if x == 5:
-                        print("Renaming {t} to {t}_old and creating new table to continue sync.".format(t=self.table))
-                        self.db.execute("""ALTER TABLE {tname} RENAME TO {tname}_old;""".format(tname=self.table, ))
-                        n_col = ', '.join("'{}' {}".format(key, val) for key, val in self.columns.items())
-
-                        self.db.execute('''CREATE TABLE IF NOT EXISTS {}
-                                                    ({})'''.format(self.table, n_col))
-                        insert_data()
-                    else:
-                        print("ERROR: {}\n Waiting 15 seconds then trying again.\nTry {} out of 5".format(e, x))
-                        time.sleep(15)
-                        insert_data(x + 1)
-
-            insert_data()
+            # Insert data, if database is locked, waits 15 seconds, then retries
+            with self.metrics.stage('insert'):
+                self._insert_rows_(col, sql_data)
+                rows, latest = self._loaded_before_()
+                self.record_sync_state(self.last_date(self.data, latest), rows + len(self.data))
+                self._clear_checkpoint_()
+            self.metrics.count('rows', len(sql_data))
 
             print("Table has been populated, commit() to finalize operation.")
 
@@ -362,11 +1133,61 @@ class ElqBulk(object):
                   'to grab data from Eloqua before writing to a database.')
             exit()
 
+    def stream_to_database(self, batch_size=10000, limit=50000, commit_every=5):
+        """
+        Stream the export straight into the database table in fixed size batches, committing as it goes.
+        Only the pages in flight are held in memory, no matter how large the table is.
+        Use after get_initial_data(stream=True) or get_sync_data(stream=True).
+        The download offset is checkpointed with every commit, so an interrupted run resumes from the last commit.
+        :param batch_size: number of records per insert
+        :param limit: number of records per page requested from Eloqua
+        :param commit_every: number of batches between commits
+        :return: number of records loaded
+        """
+
+        print("-" * 50)
+        print('Streaming data into SQL database...')
+
+        total = 0
+        batches = 0
+        # A resumed export carries on from the records committed by the interrupted run
+        committed, latest = self._loaded_before_()
+        if self.checkpointed and self.checkpoint is not None:
+            batches = self.checkpoint['committed_batches']
+
+        pages = self.metrics.timed(self.iter_export_data(limit=limit, offset=self.offset), 'download')
+
+        for page in pages:
+            for i in range(0, len(page), batch_size):
+                batch = page[i:i + batch_size]
+                with self.metrics.stage('insert'):
+                    col, sql_data = self.prepare_rows(batch)
+                    self._insert_rows_(col, sql_data)
+                latest = self.last_date(batch, latest)
+                self.metrics.count('rows', len(batch))
+
+                total += len(batch)
+                batches += 1
+                if batches % commit_every == 0:
+                    with self.metrics.stage('commit'):
+                        self._update_checkpoint_(self.offset + total, batches, latest)
+                        self.db.commit()
+                    print("{} records committed to {}.".format(total, self.table))
+
+        # The watermark is only recorded once the whole export is in, an interrupted run resumes from its checkpoint
+        self.record_sync_state(latest, committed + total)
+        self._clear_checkpoint_()
+
+        print("Streamed {} records into {}, commit() to finalize operation.".format(total, self.table))
+
+        return total
+
     def commit(self):
         """
         Commit all changes to teh database
         """
-        self.db.commit()
+        with self.metrics.stage('commit'):
+            self.db.commit()
         print("Data has been committed, close() when finished")
 
     def clear(self):
@@ -377,12 +1198,136 @@ class ElqBulk(object):
 
     def close(self):
         """
-        Safely close down the database
+        Safely close down the database, recording the run in run_history
         """
+        self.metrics.finish(self.db)
+        self.db.commit()
         self.db.close()
         print('Database has been safely closed.')
 
 
+def sync_date_field(table):
+    """
+    Name of the column that tracks when a record in the table last changed
+    :param table: name of the Eloqua table
+    """
+
+    if table in ('contacts', 'accounts'):
+        return 'updatedAt'
+
+    return 'ActivityDate'
+
+
+def run_syncs(tables, submit, on_ready, workers=4, **kwargs):
+    """
+    Run the Eloqua syncs of several tables at the same time with asyncio. Every table's export is submitted
+    up front, all of the syncs are polled concurrently with a growing interval, and each table is handed
+    to on_ready as soon as its own sync has finished, while Eloqua keeps working on the others.
+    :param tables: list of table names
+    :param submit: function taking a table name and returning an ElqBulk instance with a submitted sync,
+                   e.g. after submit_sync()
+    :param on_ready: function taking the ElqBulk instance once its sync has finished, e.g. to download it
+    :param workers: number of tables downloaded by on_ready at the same time
+    :param kwargs: timeout, interval, max_interval and backoff, see wait_sync()
+    :return: dictionary of table: (value returned by on_ready, exception raised or None)
+    """
+
+    return asyncio.run(_run_syncs_(tables, submit, on_ready, workers, kwargs))
+
+
+async def _run_syncs_(tables, submit, on_ready, workers, poll):
+    """
+    Coroutine behind run_syncs()
+    """
+
+    loop = asyncio.get_running_loop()
+    downloads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+
+    async def run(table):
+        try:
+            tb = await loop.run_in_executor(None, submit, table)
+            await tb.wait_sync_async(**poll)
+            return table, (await loop.run_in_executor(downloads, on_ready, tb), None)
+        except (Exception, SystemExit) as e:
+            return table, (None, e)
+
+    try:
+        results = await asyncio.gather(*(run(table) for table in tables))
+    finally:
+        downloads.shutdown()
+
+    return dict(results)
+
+
+def _poll_delays_(interval=1, max_interval=30, backoff=1.5):
+    """
+    Waits between sync status checks, growing by backoff up to max_interval
+    """
+
+    delay = interval
+    while True:
+        yield delay
+        delay = min(delay * backoff, max_interval)
+
+
+def _arrow_values_(values, fn):
+    """
+    Convert a column of a page for a typed Arrow array, a value that can't be converted is written as null
+    instead of failing the whole file
+    :param fn: converter of the column, see dbutils.converter_for()
+    :return: (list of converted values, number of values set to None)
+    """
+
+    kind = datetime.datetime if fn is dbutils.to_datetime else (int, float)
+
+    converted = []
+    bad = 0
+    for value in map(fn, values):
+        if value is not None and (not isinstance(value, kind) or isinstance(value, bool)):
+            value = None
+            bad += 1
+        converted.append(value)
+
+    return converted, bad
+
+
+def _filter_value_(value):
+    """
+    Format a filter date the way the Bulk API expects it
+    """
+
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+
+    return value
+
+
+def last_sync_date(db, table):
+    """
+    Find the last date in updatedAt or ActivityDate for a table, from sync_state
+    or from the indexed date column if the table has no recorded sync yet
+    :param db: open sqlite3 connection
+    :param table: name of the Eloqua table
+    :return: last date in the table, None if the table is empty
+    """
+
+    watermark = dbutils.get_watermark(db, table)
+    if watermark is not None:
+        return watermark
+
+    date_field = sync_date_field(table)
+
+    c = db.cursor()
+    c.execute("""SELECT {} AS "{} [timestamp]" FROM {} ORDER BY {} DESC LIMIT 1;""".format(
+        date_field, date_field, table, date_field))
+
+    row = c.fetchone()
+    if row is None:
+        return None
+
+    return row[0]
+
+
 def main():
     """
     create db for testing
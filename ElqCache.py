@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# ElqCache by Greg Bernard
+
+import os
+import json
+import time
+import threading
+import tempfile
+
+# One lock per cache file, shared by every ElqCache instance in the process
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for_(filename):
+    """
+    Lock guarding a cache file within this process
+    """
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+
+class ElqCache(object):
+    """
+    A small on-disk JSON cache for information about the Eloqua instance that rarely changes.
+    Entries are stored with the time they were written so callers can apply their own TTL,
+    and the file is replaced atomically so separate processes can share it.
+    """
+
+    def __init__(self, filename='eloqua_cache.json'):
+        """
+        :param filename: Name of the cache file
+        """
+
+        self.filename = filename
+        self.lock = _lock_for_(filename)
+
+    def _read_(self):
+        """
+        Load every entry from the cache file, a missing or damaged file is an empty cache
+        """
+
+        try:
+            with open(self.filename, 'r') as fopen:
+                return json.load(fopen)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_(self, entries):
+        """
+        Replace the cache file with the given entries
+        """
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fopen:
+            json.dump(entries, fopen)
+        os.replace(tmp, self.filename)
+
+    def peek(self, key):
+        """
+        Return the stored entry for a key whatever its age
+        :return: dict with keys 'time' and 'value', None if the key was never stored
+        """
+
+        with self.lock:
+            return self._read_().get(key)
+
+    def get(self, key, ttl=None):
+        """
+        Return the value for a key
+        :param key: cache key
+        :param ttl: maximum age of the entry in seconds, None never expires
+        :return: the stored value, None if missing or expired
+        """
+
+        entry = self.peek(key)
+
+        if entry is None:
+            return None
+        if ttl is not None and time.time() - entry['time'] > ttl:
+            return None
+
+        return entry['value']
+
+    def set(self, key, value):
+        """
+        Store a value for a key
+        """
+
+        with self.lock:
+            entries = self._read_()
+            entries[key] = {'time': time.time(), 'value': value}
+            self._write_(entries)
+
+    def invalidate(self, prefix=''):
+        """
+        Remove every key starting with prefix, removes everything by default
+        :return: number of entries removed
+        """
+
+        with self.lock:
+            entries = self._read_()
+            keys = [k for k in entries if k.startswith(prefix)]
+            for k in keys:
+                del entries[k]
+            self._write_(entries)
+
+        return len(keys)
+
+
+def cache_key(*parts):
+    """
+    Build a cache key out of its parts, e.g. cache_key('fields', company, table)
+    """
+    return '/'.join(str(p) for p in parts)
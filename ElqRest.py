@@ -2,21 +2,36 @@
 # ElqRest functions by Greg Bernard
 
 import datetime
-import requests
+import hashlib
+import json
+import itertools
+import collections
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import config
+import transport
+import budget
 import sqlite3
 import time
 import TableNames
+import dbutils
+from metrics import RunMetrics
+from ElqCache import ElqCache
 
 
 API_VERSION = '2.0'  # Change to use a different API version
 POST_HEADERS = {'Content-Type': 'application/json'}
+ACTIVITY_WORKERS = 8  # External activities requested at the same time, keep it within your API rate limit
+PAGE_WORKERS = 4  # Pages of campaigns or users requested at the same time
+OFFSET_STEP = 900  # Time zones only change their UTC offset on a quarter hour, see local_times()
+DAY = 86400  # Seconds in a day, offsets are looked up per day unless they change during it
 
 
 class ElqRest(object):
 
     def __init__(self, sync=None, company=config.company, username=config.username,
-                 password=config.password, filename='EloquaDB.db'):
+                 password=config.password, filename='EloquaDB.db', **kwargs):
         """
         :param string sync: Eloqua object to sync to database,
                             if you provide a value all relevant methods will automatically be called
@@ -25,54 +40,69 @@ class ElqRest(object):
         :param string password: Eloqua password
         :param string company: Eloqua company instance
         :param string filename: Name of database file
+        :param cache: ElqCache the login details are kept in, None logs in every time
+        :param login_ttl: seconds cached login details are used for
+        :param budget: budget.Budget the API calls are taken from, defaults to the budget shared by the process
+        :param priority: priority of the job's API calls: high, normal or low,
+                         defaults to low for external activities and normal for everything else
         """
 
-        url = 'https://login.eloqua.com/id'
-        req = requests.get(url, auth=(company + '\\' + username,
-                                      password))
+        # Stage timings and counts of rows, bytes and API calls, reported under the table name once it is known
+        self.metrics = RunMetrics('rest', sync)
 
         self.sync = sync
         self.filename = filename
+        self.run_started = dbutils.now()
 
         print("-"*50)
         print("Beginning {} sync.".format(sync))
 
-        if all(arg is not None for arg in (username, password, company)):
-
-            if req.json() == 'Not authenticated.':
-                raise ValueError('Invalid login credentials')
-            else:
-                self.username = username
-                self.password = password
-                self.company = company
-                self.auth = (company + '\\' + username, password)
-                self.user_id = req.json()['user']['id']
-                self.user_display = req.json()['user']['displayName']
-                self.url_base = req.json()['urls']['base']
-                self.site_id = req.json()['site']['id']
-
-                self.rest_bs_un = req.json()['urls']['apis'][
-                    'rest']['standard']
-                self.rest_base = self.rest_bs_un.format(
-                    version=API_VERSION)
-
-        else:
+        if any(arg is None for arg in (username, password, company)):
             raise Exception(
                 'Please enter all required login details: company, username, password')
 
+        self.username = username
+        self.password = password
+        self.company = company
+        self.auth = (company + '\\' + username, password)
+
+        # Keep-alive session with timeouts and retries, shared with every other job using these credentials
+        self.transport = transport.shared(self.auth)
+
+        # API calls are rate limited and taken from the daily quota, the long external activity crawl goes last
+        self.budget = kwargs.get('budget', budget.shared())
+        self.priority = kwargs.get('priority', 'low' if sync == 'external' else 'normal')
+
+        # The base urls are cached between runs, only the first job of the day logs in
+        with self.metrics.stage('authenticate'):
+            login = transport.login(company, username, password, cache=kwargs.get('cache', ElqCache()),
+                                    ttl=kwargs.get('login_ttl', transport.LOGIN_TTL), metrics=self.metrics,
+                                    budget=self.budget)
+
+        self.user_id = login['user']['id']
+        self.user_display = login['user']['displayName']
+        self.url_base = login['urls']['base']
+        self.site_id = login['site']['id']
+
+        self.rest_bs_un = login['urls']['apis']['rest']['standard']
+        self.rest_base = self.rest_bs_un.format(version=API_VERSION)
+
         self.db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self.c = self.db.cursor()
 
     # BASE GET METHOD ----------------------------------------------------------------------------------------
 
-    def get(self, asset_id=None, count=500, page=1):
+    def get(self, asset_id=None, count=500, page=1, search=None):
         """
         Get REST API 2.0 data from Eloqua
         :param asset_id: If your asset is meant to only pull one at a time,
                         provide the ID for the asset you wish to pull
         :param count: If your asset is pulled in batches, the size of the batch
         :param page: The page you wish to pull, size of the page is determined by your batch size
-        :return: The requested data
+        :param search: Eloqua search expression for assets pulled in batches, e.g. updatedAt>=1500000000
+        :return: The requested data, None if there is nothing with this id (404)
+        :raise Exception: if Eloqua answered with any other error once the transport gave up retrying,
+                          so a failed request is never mistaken for a deleted activity
         """
 
         depth = ""
@@ -111,87 +141,261 @@ class ElqRest(object):
         else:
             page_item = "page={}&".format(page)
 
+        if search is None or self.sync not in multi_assets:
+            search_item = ""
+        else:
+            search_item = "search={}&".format(search)
+
         if (self.sync not in multi_assets) and (asset_id is not None):
             asset_id = asset_id
         else:
             asset_id = "?"
 
         url = self.rest_base + str(asset_type) + \
-            str(asset_id) + page_item + count_item + depth
+            str(asset_id) + page_item + count_item + search_item + depth
         # print(url)
-        req = requests.get(url, auth=self.auth)
+        with self.metrics.stage('download', event=False):
+            req = self.transport.get(url, metrics=self.metrics, budget=self.budget, priority=self.priority)
+        self.metrics.count('bytes', len(req.content))
 
         if req.status_code == 200:
             return req.json()
-        else:
-            print("Error Code: {}".format(req.status_code))
+        elif req.status_code == 404:
+            # Nothing with this id, e.g. a deleted activity
             return None
+        else:
+            raise Exception("ElqRest: request for {} failed, Error Code: {}".format(url, req.status_code))
 
     # GET SPECIFIC DATA FROM REST ---------------------------------------------------------------------------
 
-    def get_activities(self, start=1, end=999999):
+    def iter_activities(self, start=1, end=999999, workers=1, max_gap=0):
         """
-        Use the get method to pull all available records in the provided range
+        Use the get method to pull all available records in the provided range, one at a time as they arrive
         :param start: starting record ID
         :param end:  ending record ID
-        :return: list of dicts containing activities data
+        :param workers: number of requests in flight at the same time, the records are still yielded in id order
+        :param max_gap: number of missing ids in a row (deleted activities) skipped before the export stops,
+                        None exports the whole range
+        :return: generator of dicts containing activities data. A request that fails with anything but a 404
+                 raises once every activity before it has been yielded
         """
-        activities = []
 
-        for i in range(start, end):
-            data = self.get(asset_id=i)
-            if data is not None:
-                activities.append(data)
+        last, gap, skipped = start - 1, 0, 0
+
+        fetched = self._fetch_activities_(range(start, end), workers)
+        try:
+            for i, data in fetched:
+                if data is None:
+                    gap += 1
+                    if max_gap is not None and gap > max_gap:
+                        break
+                    continue
+
+                skipped += gap
+                gap = 0
+                last = i
+                yield data
+        finally:
+            fetched.close()
+
+        if skipped:
+            print("Skipped {} missing activity ids.".format(skipped))
+        print("No more activity data, last record exported: {}.".format(last))
+
+    def _fetch_activities_(self, ids, workers=1):
+        """
+        Request every activity id, with up to workers requests in flight
+        :return: generator of (id, activity or None if there is none), in id order
+        """
+
+        if workers <= 1:
+            for i in ids:
+                yield i, self.get(asset_id=i)
+            return
+
+        ids = iter(ids)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Requests for the next ids, oldest first, never more than workers at a time
+            window = collections.deque((i, pool.submit(self.get, asset_id=i)) for i in itertools.islice(ids, workers))
+            try:
+                while window:
+                    i, future = window.popleft()
+                    following = next(ids, None)
+                    if following is not None:
+                        window.append((following, pool.submit(self.get, asset_id=following)))
+                    yield i, future.result()
+            finally:
+                for i, future in window:
+                    future.cancel()
+
+    def find_last_activity(self, start=1, probe=5):
+        """
+        Find the id of the newest external activity by doubling the distance from start until no activities
+        are found, then halving the gap between the last id found and the first id missing.
+        This takes a logarithmic number of calls. Every step checks up to probe ids in a row,
+        so deleted activities do not hide the ones after them unless probe of them were deleted in a row.
+        :param start: id to search from, e.g. the last id already exported
+        :param probe: number of ids in a row checked at every step
+        :return: id of the newest activity, None if there are none from start onwards
+        """
+
+        if not self._activity_near_(start, probe):
+            return None
+
+        # Double the distance until ids with no activities are reached
+        low, step = start, 1
+        while self._activity_near_(low + step, probe):
+            low += step
+            step *= 2
+        high = low + step
+
+        # There are activities from low onwards and none from high onwards, close the gap
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._activity_near_(middle, probe):
+                low = middle
             else:
-                print("No more activity data, last record exported: {}.".format(i-1))
-                break
+                high = middle
+
+        print("Newest external activity: {}".format(low))
+
+        return low
+
+    def _activity_near_(self, activity_id, probe):
+        """
+        True if any of the probe activity ids from activity_id onwards exists,
+        a failed request raises instead of counting as a missing activity, see get()
+        """
+        return any(self.get(asset_id=i) is not None for i in range(activity_id, activity_id + probe))
+
+    def get_activities(self, start=1, end=999999, workers=1, max_gap=0):
+        """
+        Use the get method to pull all available records in the provided range
+        :param start: starting record ID
+        :param end:  ending record ID
+        :param workers: number of requests in flight at the same time
+        :param max_gap: number of missing ids in a row skipped before the export stops
+        :return: list of dicts containing activities data
+        """
+        activities = list(self.iter_activities(start=start, end=end, workers=workers, max_gap=max_gap))
 
         self.sync = 'external'
 
         return activities
 
-    def get_campaigns(self, count=1000, p_start=1, p_end=999999):
+    def iter_pages(self, count=1000, p_start=1, p_end=999999, search=None, workers=1):
         """
-        Pulls all campaigns from Eloqua in a defined range.
+        Pulls pages of campaigns or users from Eloqua in a defined range. The total on the first page gives
+        the number of pages, the others are then requested workers at a time and yielded as they arrive,
+        so they do not come in page order when workers is above 1.
+        A page Eloqua does not return, once the transport has retried it, stops the export with an exception,
+        so a sync never records a watermark past a missing page
         :param count: Size of batch to pull per page
         :param p_start: Page to start on
         :param p_end: Page to finish on
-        :return:
+        :param search: Eloqua search expression, only assets matching it are pulled
+        :param workers: number of pages requested at the same time
+        :return: generator of lists of asset dicts
         """
-        campaigns = []
 
         print("Starting export on page: {}".format(p_start))
 
-        for i in range(p_start, p_end):
-            data = self.get(count=count, page=i)['elements']
-            if len(data) != 0:
-                campaigns.extend(data)
-            else:
-                print("No more campaign data, last page exported: {}".format(i-1))
-                break
+        first = self._get_page_(count, p_start, search)
+        if len(first['elements']) == 0:
+            print("No more {} data, last page exported: {}".format(self.sync, p_start - 1))
+            return
+        yield first['elements']
+
+        if first.get('total') is None:
+            # Without a total, pages are pulled one by one until an empty one
+            for i in range(p_start + 1, p_end):
+                data = self._get_page_(count, i, search)
+                if len(data['elements']) == 0:
+                    print("No more {} data, last page exported: {}".format(self.sync, i - 1))
+                    return
+                yield data['elements']
+            return
+
+        last = min(p_end - 1, -(-int(first['total']) // count))
+        pages = iter(range(p_start + 1, last + 1))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            pending = set(pool.submit(self._get_page_, count, i, search)
+                          for i in itertools.islice(pages, max(workers, 1)))
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        following = next(pages, None)
+                        if following is not None:
+                            pending.add(pool.submit(self._get_page_, count, following, search))
+                        yield future.result()['elements']
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        print("No more {} data, last page exported: {}".format(self.sync, last))
+
+    def _get_page_(self, count, page, search):
+        """
+        Get one page of campaigns or users
+        :raise Exception: if Eloqua did not return the page
+        """
+
+        data = self.get(count=count, page=page, search=search)
+        if data is None:
+            raise Exception("ElqRest: page {} of {} could not be exported.".format(page, self.sync))
+
+        return data
+
+    def iter_campaigns(self, count=1000, p_start=1, p_end=999999, search=None, workers=1):
+        """
+        Pulls all campaigns from Eloqua in a defined range, one page at a time
+        :param count: Size of batch to pull per page
+        :param p_start: Page to start on
+        :param p_end: Page to finish on
+        :param search: Eloqua search expression, only campaigns matching it are pulled
+        :param workers: number of pages requested at the same time, see iter_pages()
+        :return: generator of campaign dicts
+        """
+
+        for page in self.iter_pages(count=count, p_start=p_start, p_end=p_end, search=search, workers=workers):
+            yield from page
+
+    def get_campaigns(self, count=1000, p_start=1, p_end=999999, search=None, workers=1):
+        """
+        Pulls all campaigns from Eloqua in a defined range.
+        :param count: Size of batch to pull per page
+        :param p_start: Page to start on
+        :param p_end: Page to finish on
+        :param search: Eloqua search expression, only campaigns matching it are pulled
+        :param workers: number of pages requested at the same time
+        :return:
+        """
+        campaigns = list(self.iter_campaigns(count=count, p_start=p_start, p_end=p_end, search=search,
+                                             workers=workers))
 
         self.sync = 'campaigns'
 
         return campaigns
 
-    def get_users(self, count=1000, p_start=1, p_end=9999999):
+    def iter_users(self, count=1000, p_start=1, p_end=9999999, search=None, workers=1):
+        """
+        Pulls all users from Eloqua in a defined range, one page at a time
+        :param count: Size of batch to pull per page
+        :param p_start: Page to start on
+        :param p_end: Page to finish on
+        :param search: Eloqua search expression, only users matching it are pulled
+        :param workers: number of pages requested at the same time, see iter_pages()
+        :return: generator of user dicts
+        """
 
-        users = []
+        for page in self.iter_pages(count=count, p_start=p_start, p_end=p_end, search=search, workers=workers):
+            yield from page
 
-        print("Starting export...")
+    def get_users(self, count=1000, p_start=1, p_end=9999999, search=None, workers=1):
 
-        for i in range(p_start, p_end):
-            try:
-                data = self.get(count=count, page=i)['elements']
-            except TypeError:
-                break
-            # print(i)
-            if len(data) != 0:
-                # print(data)
-                users.extend(data)
-            else:
-                print("No more user data, last page exported: {}".format(i-1))
-                break
+        users = list(self.iter_users(count=count, p_start=p_start, p_end=p_end, search=search, workers=workers))
 
         self.sync = 'users'
 
@@ -199,19 +403,108 @@ class ElqRest(object):
 
     # DATA INSERTION  ----------------------------------------------------------------------------------------
 
-    def insert_data(self, table, col_count, sql_data):
+    def insert_batch(self, table, col_count, sql_data, watermark=None):
         """
-        Local function that allows a wait period if database file is busy, then retries
+        Local function that allows a wait period if database file is busy, then retries.
+        Nothing is committed, so a batch and its sync_state record are committed together.
+        :param watermark: highest id or date in sql_data, recorded in sync_state with the data
         """
 
         try:
-            self.c.executemany("""INSERT OR REPLACE INTO {} VALUES ({});""".format(
-                table, ",".join("?" * col_count)), sql_data)
+            with self.metrics.stage('insert'):
+                self.c.executemany("""INSERT OR REPLACE INTO {} VALUES ({});""".format(
+                    table, ",".join("?" * col_count)), sql_data)
         except sqlite3.OperationalError:
             print("ElqRest: Another application is currently using the database,"
                   " waiting 15 seconds then attempting to continue.")
             time.sleep(15)
-            self.insert_data(table, col_count, sql_data)
+            return self.insert_batch(table, col_count, sql_data, watermark)
+
+        dbutils.update_sync_state(self.c, table, watermark, len(sql_data), self.run_started)
+        self.metrics.count('rows', len(sql_data))
+
+    def _write_sink_(self, sink, records):
+        """
+        Write records to a sink as they arrive, then record the run
+        """
+
+        self.metrics.count('rows', sink.write_many(records))
+        self.metrics.finish(self.db)
+        self.db.commit()
+
+    def _updated_since_(self, table, incremental):
+        """
+        Search expression for the assets updated since the last sync of a table
+        :return: search expression, None to pull every asset
+        """
+
+        if not incremental:
+            return None
+
+        since = dbutils.get_watermark(self.db, table, timestamp=False)
+        if since is None:
+            print("There is no pre-existing data in this table.")
+            return None
+
+        print("Extracting everything updated since: {}".format(datetime.datetime.fromtimestamp(int(since))))
+        # Assets updated in the same second as the last sync are pulled again, their hashes show they are unchanged
+        return "updatedAt>={}".format(int(since))
+
+    def _changed_rows_(self, table, records, stored):
+        """
+        Drop the records whose content is the same as when they were last loaded, and store the hashes of the rest
+        :param records: list of (id, row)
+        :param stored: dictionary of id: hash of the records already loaded, see dbutils.get_row_hashes()
+        :return: list of the rows to load
+        """
+
+        rows, hashes = [], {}
+        for asset_id, row in records:
+            digest = hashlib.sha1(json.dumps(row, default=str).encode('utf-8')).hexdigest()
+            if stored.get(str(asset_id)) != digest:
+                rows.append(row)
+                hashes[asset_id] = digest
+
+        dbutils.save_row_hashes(self.c, table, hashes)
+
+        if len(records) != len(rows):
+            print("Skipped {} unchanged records.".format(len(records) - len(rows)))
+            self.metrics.count('unchanged', len(records) - len(rows))
+
+        return rows
+
+    def _load_pages_(self, table, pages, to_rows, col_count, incremental):
+        """
+        Insert and commit every page of campaigns or users as it arrives, skipping the unchanged ones.
+        The highest updatedAt is only recorded once every page is in, as pages are not in updatedAt order,
+        if a page could not be exported the pages already loaded are kept and nothing is recorded.
+        :param pages: iterable of lists of asset dicts, see iter_pages()
+        :param to_rows: function turning a page into a list of (id, row)
+        :param incremental: False loads every record, whatever its hash
+        """
+
+        stored = dbutils.get_row_hashes(self.c, table) if incremental else {}
+
+        watermark = None
+        try:
+            for page in pages:
+                updated = dbutils.max_value([{'updatedAt': int(d['updatedAt'])} for d in page
+                                             if d.get('updatedAt')], 'updatedAt')
+                if updated is not None and (watermark is None or updated > watermark):
+                    watermark = updated
+
+                sql_data = self._changed_rows_(table, to_rows(page), stored)
+                self.insert_batch(table=table, col_count=col_count, sql_data=sql_data)
+                self.db.commit()
+        except Exception:
+            self.metrics.finish(self.c, status='error')
+            self.db.commit()
+            self.db.close()
+            print("ERROR: sync_state was not updated for {}, sync it again to load the missing pages.".format(table))
+            raise
+
+        dbutils.update_sync_state(self.c, table, watermark, 0, self.run_started)
+        self.metrics.finish(self.c)
 
         self.db.commit()
         self.db.close()
@@ -219,152 +512,289 @@ class ElqRest(object):
 
     # DATA PROCESSING STEPS ----------------------------------------------------------------------------------
 
-    def export_campaigns(self, table='Campaigns'):
+    def export_campaigns(self, table='Campaigns', sink=None, incremental=True, workers=PAGE_WORKERS):
         """
         Populates campaigns table in the database.
         :param table: name of the table to create, or search in the database
+        :param sink: jsonsink.JsonlSink, if provided the raw campaigns are written to it
+                     as they arrive instead of being loaded into the database
+        :param incremental: only pull the campaigns updated since the last sync, and only write those that changed,
+                            False pulls and writes every campaign
+        :param workers: number of pages requested at the same time
         """
 
+        self.metrics.table = table
+
+        if sink is not None:
+            self._write_sink_(sink, self.iter_campaigns(count=1000, workers=workers))
+            return
+
         col = ', '.join("'{}' {}".format(key, val) for key, val in TableNames.campaign_col_def.items())
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS {table} ({columns});'''
                        .format(table=table, columns=col))
 
-        new_data = self.get_campaigns(count=1000)
-        sql_data = []
-        date_columns = [k for k, v in TableNames.campaign_col_def.items() if v.find('DATETIME') >= 0]
+        pages = self.iter_pages(count=1000, search=self._updated_since_(table, incremental), workers=workers)
+        self._load_pages_(table, pages, self._campaign_rows_, len(TableNames.campaign_col_def), incremental)
 
-        for d in new_data:
-            dic = {}
+    @staticmethod
+    def _campaign_rows_(new_data):
+        """
+        Turn a page of campaigns into rows of the campaigns table
+        :return: list of (id, row)
+        """
 
-            for c in date_columns:
-                # Convert unix timestamps to datetime
-                try:
-                    d[c] = datetime.datetime.fromtimestamp(
-                        int(d[c])).strftime('%Y-%m-%d %H:%M:%S')
-                except KeyError:
-                    d[c] = ""
-                    continue
+        date_columns = [k for k, v in TableNames.campaign_col_def.items() if v.find('DATETIME') >= 0]
+        fields = {'Field {}'.format(n + 1): n for n in range(3)}
 
+        def field_value(d, key):
             try:
-                d['Field 1'] = d['fieldValues'][0]['value']
-                d['Field 2'] = d['fieldValues'][1]['value']
-                d['Field 3'] = d['fieldValues'][2]['value']
-            except KeyError:
-                d['Field 1'] = ""
-                d['Field 2'] = ""
-                d['Field 3'] = ""
-
-            for k in TableNames.campaign_col_def.keys():
-                try:
-                    dic[k] = d[k]
-                except KeyError:
-                    dic[k] = ''
-                    continue
-
-            sql_data.append(list(dic.values()))
+                return d['fieldValues'][fields[key]]['value']
+            except (KeyError, IndexError):
+                return ''
 
-        print("-"*50)
-        col_count = len(sql_data[0])
+        rows = page_rows(new_data, TableNames.campaign_col_def, date_columns,
+                         derived={key: field_value for key in fields})
 
-        self.insert_data(table=table, col_count=col_count, sql_data=sql_data)
+        return list(zip((d['id'] for d in new_data), rows))
 
-    def export_users(self, table='users'):
+    def export_users(self, table='users', sink=None, incremental=True, workers=PAGE_WORKERS):
         """
         Populates users table in the database.
         :param table: name of the table to create, or search in the database
+        :param sink: jsonsink.JsonlSink, if provided the raw users are written to it
+                     as they arrive instead of being loaded into the database
+        :param incremental: only pull the users updated since the last sync, and only write those that changed,
+                            False pulls and writes every user
+        :param workers: number of pages requested at the same time
         """
 
+        self.metrics.table = table
+
+        if sink is not None:
+            self._write_sink_(sink, self.iter_users(count=1000, workers=workers))
+            return
+
         col = ', '.join("'{}' {}".format(key, val) for key, val in TableNames.users_col_def.items())
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS {table} ({columns});'''
                        .format(table=table, columns=col))
 
-        new_data = self.get_users(count=1000)
-        sql_data = []
-        date_columns = [k for k, v in TableNames.users_col_def.items()
-                        if (v.find('DATETIME') >= 0) or (v.find('TIMESTAMP') >= 0)]
-
-        for d in new_data:
-            dic = {}
-            for c in date_columns:
-                # Convert unix timestamps to datetime
-                try:
-                    d[c] = datetime.datetime.fromtimestamp(
-                        int(d[c])).strftime('%Y-%m-%d %H:%M:%S')
-                except KeyError:
-                    d[c] = ""
-                    continue
+        pages = self.iter_pages(count=1000, search=self._updated_since_(table, incremental), workers=workers)
+        self._load_pages_(table, pages, self._user_rows_, len(TableNames.users_col_def), incremental)
 
-            # Remove extra columns from some users
-            if len(d) != 12:
-                for k in TableNames.users_col_def.keys():
-                    dic[k] = d[k]
-                d = dic
+    @staticmethod
+    def _user_rows_(new_data):
+        """
+        Turn a page of users into rows of the users table, extra fields some users have are left out
+        :return: list of (id, row)
+        """
 
-            sql_data.append(list(d.values()))
+        date_columns = [k for k, v in TableNames.users_col_def.items()
+                        if (v.find('DATETIME') >= 0) or (v.find('TIMESTAMP') >= 0)]
 
-        col_count = len(sql_data[0])
-        # for l in sql_data:
-        #     print(l)
-        # print(col_count)
+        rows = page_rows(new_data, TableNames.users_col_def, date_columns)
 
-        self.insert_data(table=table, col_count=col_count, sql_data=sql_data)
+        return list(zip((d['id'] for d in new_data), rows))
 
-    def export_external(self, table='External_Activity', start=None, end=99999):
+    def export_external(self, table='External_Activity', start=None, end=99999, sink=None,
+                        workers=ACTIVITY_WORKERS, batch_size=500):
         """
         Populates external activity table in the database.
         :param table: name of the table to create, or search in the database
         :param start: record to start from
         :param end: integer, non-inclusive
+        :param sink: jsonsink.JsonlSink, if provided the raw activities are written to it
+                     as they arrive instead of being loaded into the database
+        :param workers: number of activities requested from Eloqua at the same time
+        :param batch_size: number of activities inserted and committed at a time
         """
 
+        self.metrics.table = table
+
         col = ', '.join("'{}' {}".format(key, val) for key, val in TableNames.external_col_def.items())
         # col = col + ", FOREIGN KEY(ContactId) REFERENCES contacts(ContactId)"
 
-        try:
-            self.c.execute("""SELECT {id} FROM {table} ORDER BY {id} DESC LIMIT 1;"""
-                           .format(id='id', table=table))
-        except sqlite3.OperationalError:
-            self.c.execute('''CREATE TABLE IF NOT EXISTS {} ({});'''.format(table, col))
+        self.c.execute('''CREATE TABLE IF NOT EXISTS {} ({});'''.format(table, col))
 
-        # If a start value is given, starts from that, otherwise starts from the first value in the table
-        # and if there is no table, starts from the first value, and continues until none are left
+        # If a start value is given, starts from that, otherwise starts from the last id recorded in sync_state,
+        # or the last value in the table if it was never recorded there,
+        # and if the table is empty, starts from the first value, and continues until none are left
 
-        try:
-            if start is None:
-                start = self.c.fetchone()[0]
-            else:
-                start = start
+        if start is None:
+            start = dbutils.get_watermark(self.db, table, timestamp=False)
+
+        if start is None:
+            start = self.c.execute("""SELECT MAX({id}) FROM {table};""".format(id='id', table=table)).fetchone()[0]
 
+        if start is not None:
             if end != 99999:
                 print("Extracting from {} to {}.".format(start, end-1))
             else:
                 print("Extracting everything after: {}".format(start) + "\nThis could take a while.")
 
-            new_data = self.get_activities(start=int(start), end=end)
-
-        except TypeError:
+        else:
             print("There is no pre-existing data in this table.")
             if end != 99999:
                 print("Extracting from {} to {}.".format(1, end-1))
             else:
                 print("Extracting everything... This may take a while.")
-            new_data = self.get_activities(start=1, end=end)
+            start = 1
+
+        # Find the newest activity first, then export every activity up to it, skipping deleted ones
+        status = 'success'
+        try:
+            last = self.find_last_activity(start=int(start))
+        except budget.BudgetExhausted as e:
+            print("Stopping the export: {}".format(e))
+            status = 'budget_exhausted'
+            last = None
+        except Exception:
+            self.metrics.finish(self.c, status='error')
+            self.db.commit()
+            self.db.close()
+            print("ERROR: The newest external activity could not be found, nothing was exported.")
+            raise
+
+        if last is None:
+            print("There are no new external activities.")
+            last = int(start) - 1
+
+        activities = self.iter_activities(start=int(start), end=min(end, last + 1), workers=workers, max_gap=None)
+
+        if sink is not None:
+            self._write_sink_(sink, activities)
+            return
+
+        # Activities are inserted and committed batch by batch as they arrive, so an export stopped
+        # by the API budget keeps everything it got, and the next sync continues from there
+        total = 0
+        new_data = []
+        error = None
+        try:
+            for d in activities:
+                new_data.append(d)
+                if len(new_data) == batch_size:
+                    total += self._insert_activities_(table, new_data, first=total == 0)
+                    new_data = []
+        except budget.BudgetExhausted as e:
+            print("Stopping the export: {}".format(e))
+            status = 'budget_exhausted'
+        except Exception as e:
+            # Activities arrive in id order, the ones before the failed id are kept and the watermark stops
+            # before it, so the next sync requests it again
+            print("ERROR: Stopping the export, an external activity could not be exported: {}".format(e))
+            status = 'error'
+            error = e
+
+        if len(new_data) != 0:
+            total += self._insert_activities_(table, new_data, first=total == 0)
+
+        print("{} external activities exported.".format(total))
+        self.metrics.finish(self.c, status=status)
+
+        self.db.commit()
+        self.db.close()
+        print("Data has been committed.")
+
+        if error is not None:
+            raise error
+
+    def _insert_activities_(self, table, new_data, first=False):
+        """
+        Insert and commit a batch of external activities
+        :param first: True for the first batch of the export
+        :return: number of activities inserted
+        """
 
-        col_count = len(list(new_data[0].keys()))
+        ids = [int(d['id']) for d in new_data]
+        sql_data = page_rows(new_data, TableNames.external_col_def, ['activityDate'],
+                             derived={'id': lambda d, key: int(d[key])})
 
-        print("This table contains {} columns.".format(col_count))
+        col_count = len(TableNames.external_col_def)
+        if first:
+            print("This table contains {} columns.".format(col_count))
 
-        sql_data = []
-        for d in new_data:
-            # Convert unix timestamps to datetime
-            d['activityDate'] = datetime.datetime.fromtimestamp(
-                int(d['activityDate'])).strftime('%Y-%m-%d %H:%M:%S')
-            d['id'] = int(d['id'])
-            sql_data.append(list(d.values()))
+        self.insert_batch(table=table, col_count=col_count, sql_data=sql_data, watermark=max(ids))
+        self.db.commit()
+
+        return len(new_data)
+
+
+def local_times(values):
+    """
+    Convert a column of unix timestamps to local times, e.g. 2017-08-15 10:31:02, all at once.
+    Gives the same strings as datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S') would one by one:
+    the UTC offset is looked up once per day found in the column, and once per quarter hour only on the days
+    the offset changes, e.g. when daylight saving time starts or ends.
+    :param values: list of unix timestamps, as integers or strings, missing ones as None or ''
+    :return: list of strings, '' where the timestamp is missing
+    """
+
+    present = [i for i, v in enumerate(values) if v is not None and v != '']
+    result = [''] * len(values)
+    if not present:
+        return result
+
+    seconds = np.array([values[i] for i in present], dtype=np.int64)
+
+    days, index = np.unique(seconds // DAY, return_inverse=True)
+    index = index.reshape(-1)
+    starts = np.array([_utc_offset_(int(day) * DAY) for day in days], dtype=np.int64)
+    ends = np.array([_utc_offset_(int(day + 1) * DAY) for day in days], dtype=np.int64)
+    offsets = starts[index]
+
+    changing = (starts != ends)[index]
+    if changing.any():
+        steps, step_index = np.unique(seconds[changing] // OFFSET_STEP, return_inverse=True)
+        step_offsets = np.array([_utc_offset_(int(step) * OFFSET_STEP) for step in steps], dtype=np.int64)
+        offsets[changing] = step_offsets[step_index.reshape(-1)]
+
+    local = (seconds + offsets).astype('datetime64[s]')
+    strings = np.char.replace(np.datetime_as_string(local, unit='s'), 'T', ' ').tolist()
+
+    for i, string in zip(present, strings):
+        result[i] = string
+
+    return result
+
+
+@functools.lru_cache(maxsize=8192)
+def _utc_offset_(timestamp):
+    """
+    Seconds the local time zone is ahead of UTC at a unix timestamp, remembered as most pages span the same days
+    """
+
+    moment = datetime.datetime.fromtimestamp(timestamp)
+    utc = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+
+    return int((moment - utc).total_seconds())
+
+
+def page_rows(records, col_def, date_columns=(), derived=None):
+    """
+    Turn a page of Eloqua assets into table rows column by column, in the order of the column definitions.
+    Missing fields are left empty.
+    :param records: list of assets, as returned by the REST API
+    :param col_def: column definitions of the table, see TableNames
+    :param date_columns: columns holding unix timestamps, converted to local times with local_times()
+    :param derived: dictionary of column: function(asset, column) returning the value of that column
+    :return: list of row tuples
+    """
+
+    derived = derived or {}
+    columns = []
+
+    for key in col_def:
+        if key in derived:
+            values = [derived[key](d, key) for d in records]
+        else:
+            values = [d.get(key, '') for d in records]
+        if key in date_columns:
+            values = local_times(values)
+        columns.append(values)
 
-        self.insert_data(table=table, col_count=col_count, sql_data=sql_data)
+    return list(zip(*columns))
 
 
 def main():
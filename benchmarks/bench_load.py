@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# SQLite load benchmark by Greg Bernard
+
+"""
+Compares the default load path of ElqBulk (INSERT OR REPLACE, default journal settings)
+with the fast load path (WAL, then plain inserts into an empty table, or a staging table
+and set-based upsert on re-sync) on synthetic contact records.
+Run from the repository root: python benchmarks/bench_load.py --rows 200000
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dbutils
+
+TABLE = 'contacts'
+
+
+def make_columns(width):
+    """
+    Column definitions shaped like an ElqBulk contacts table
+    """
+
+    columns = {'contactID': 'TEXT PRIMARY KEY', 'createdAt': 'TIMESTAMP', 'updatedAt': 'TIMESTAMP'}
+    for i in range(width):
+        columns['C_Field{}'.format(i)] = 'INTEGER' if i % 4 == 0 else 'TEXT'
+
+    return columns
+
+
+def make_rows(columns, count, changed=0.0, version=0):
+    """
+    Synthetic records, changed is the share of records whose values differ from version 0
+    """
+
+    every = int(round(1 / changed)) if changed else 0
+    keys = list(columns)[3:]
+    rows = []
+
+    for i in range(count):
+        v = version if every and i % every == 0 else 0
+        row = [str(i), '2017-01-01 00:00:00.000', '2017-06-{:02d} 12:00:00.000'.format((i + v) % 28 + 1)]
+        for j, key in enumerate(keys):
+            n = (i * 31 + j * 7 + v * 13) % 1000
+            row.append(n if columns[key] == 'INTEGER' else 'value {}'.format(n))
+        rows.append(row)
+
+    return rows
+
+
+def load(filename, columns, rows, fast, batch_size=10000, commit_every=5):
+    """
+    Load rows the way stream_to_database() does, return records per second
+    """
+
+    db = sqlite3.connect(filename)
+    if fast:
+        dbutils.tune_for_load(db)
+
+    col = list(columns)
+    key = dbutils.primary_key(columns)
+    # Like ElqBulk.upsert(), the staging table is only used when the table already holds records
+    upsert = fast and db.execute("""SELECT 1 FROM {} LIMIT 1""".format(TABLE)).fetchone() is not None
+    insert = """INSERT OR REPLACE INTO {} {} VALUES ({})""".format(TABLE, tuple(col), ",".join("?" * len(col)))
+
+    start = time.perf_counter()
+    for n, i in enumerate(range(0, len(rows), batch_size), 1):
+        batch = rows[i:i + batch_size]
+        if upsert:
+            dbutils.upsert_rows(db, TABLE, col, batch, key)
+        else:
+            db.executemany(insert, batch)
+        if n % commit_every == 0:
+            db.commit()
+    db.commit()
+    elapsed = time.perf_counter() - start
+
+    db.close()
+
+    return len(rows) / elapsed
+
+
+def run(rows, width, changed, repeat=1):
+    """
+    Run every scenario for both load paths and print the best result of each
+    """
+
+    columns = make_columns(width)
+    initial = make_rows(columns, rows)
+    resync = make_rows(columns, rows, changed=changed, version=1)
+
+    print("{} records, {} columns, {:.0%} of records changed on re-sync".format(rows, len(columns), changed))
+    print("{:<12}{:>22}{:>22}".format('', 'initial load rec/s', 're-sync rec/s'))
+
+    results = {}
+    for _ in range(repeat):
+        for name, fast in (('default', False), ('fast_load', True)):
+            directory = tempfile.mkdtemp()
+            filename = os.path.join(directory, 'bench.db')
+
+            db = sqlite3.connect(filename)
+            db.execute('CREATE TABLE {} ({})'.format(
+                TABLE, ', '.join("'{}' {}".format(k, v) for k, v in columns.items())))
+            for sql in dbutils.index_sql(TABLE, columns):
+                db.execute(sql)
+            db.commit()
+            db.close()
+
+            first = load(filename, columns, initial, fast)
+            second = load(filename, columns, resync, fast)
+            best = results.get(name, (0, 0))
+            results[name] = (max(best[0], first), max(best[1], second))
+
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+            os.rmdir(directory)
+
+    for name, (first, second) in results.items():
+        print("{:<12}{:>22,.0f}{:>22,.0f}".format(name, first, second))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--width', type=int, default=40, help='number of fields besides the id and dates')
+    parser.add_argument('--changed', type=float, default=0.1, help='share of records changed on re-sync')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per load path, the best is reported')
+    args = parser.parse_args()
+
+    run(args.rows, args.width, args.changed, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
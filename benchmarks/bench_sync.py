@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# End-to-end sync benchmark by Greg Bernard
+
+"""
+Runs sync_table, sync_campaigns and sync_external_activities from ldbs against the local mock Eloqua server,
+and reports records per second, peak memory and the number of API calls of each sync.
+No Eloqua login or network access is needed.
+Run from the repository root: python benchmarks/bench_sync.py --records 200000 --table EmailOpen
+
+Every sync runs in a fresh process, so its peak memory is its own.
+The Bulk syncs include the wait between sync status checks, which starts at 1 second.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_eloqua import MockEloqua, patch_login
+
+SCENARIOS = ['sync_table', 'sync_campaigns', 'sync_external_activities']
+
+# Table loaded by each REST scenario
+REST_TABLES = {'sync_campaigns': 'Campaigns', 'sync_external_activities': 'External_Activity'}
+
+
+def _run_scenario_(name, base_url, directory, options, results):
+    """
+    Run one sync in a child process and put (records, seconds, peak RSS in MB) on the results queue
+    """
+
+    os.chdir(directory)
+    os.environ.setdefault('NO_PROXY', '127.0.0.1,localhost')
+    if not options['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+
+    patch_login(base_url)
+    import ldbs
+
+    filename = os.path.join(directory, 'bench.db')
+
+    start = time.perf_counter()
+    if name == 'sync_table':
+        table = options['table']
+        ldbs.sync_table(table, filename, stream=options['stream'], fast_load=options['fast_load'])
+    else:
+        table = REST_TABLES[name]
+        getattr(ldbs, name)(filename=filename)
+    elapsed = time.perf_counter() - start
+
+    db = sqlite3.connect(filename)
+    records = db.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+    db.close()
+
+    # ru_maxrss is in kilobytes on Linux
+    results.put((records, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run(scenarios, mock, options):
+    """
+    Run every scenario against the mock server
+    :return: dict of results by scenario
+    """
+
+    base_url = mock.start()
+    context = multiprocessing.get_context('spawn')
+
+    print("{} Bulk records, {} campaigns, {} external activities, {}s latency".format(
+        mock.records, mock.campaigns, mock.external, mock.latency))
+    print("{:<26}{:>10}{:>10}{:>12}{:>10}{:>11}".format('', 'records', 'seconds', 'records/s', 'peak MB', 'API calls'))
+
+    results = {}
+    for name in scenarios:
+        directory = tempfile.mkdtemp()
+        calls = mock.calls.copy()
+        queue = context.Queue()
+
+        process = context.Process(target=_run_scenario_, args=(name, base_url, directory, options, queue))
+        process.start()
+        process.join()
+
+        if process.exitcode != 0:
+            print("{:<26}failed with exit code {}".format(name, process.exitcode))
+            shutil.rmtree(directory)
+            continue
+
+        records, elapsed, rss = queue.get()
+        used = mock.calls - calls
+        results[name] = {'records': records, 'seconds': elapsed, 'records_per_second': records / elapsed,
+                         'peak_rss_mb': rss, 'api_calls': used['total'], 'calls_by_kind': dict(used)}
+
+        print("{:<26}{:>10}{:>10.2f}{:>12,.0f}{:>10.1f}{:>11}".format(
+            name, records, elapsed, records / elapsed, rss, used['total']))
+        shutil.rmtree(directory)
+
+    mock.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--table', default='EmailOpen', help='Bulk table synced by sync_table')
+    parser.add_argument('--records', type=int, default=100000, help='records in the Bulk table')
+    parser.add_argument('--width', type=int, default=20, help='extra custom fields on contacts and accounts')
+    parser.add_argument('--campaigns', type=int, default=2000)
+    parser.add_argument('--external', type=int, default=500, help='number of external activities')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--sync-delay', type=float, default=0.0, help='seconds before a Bulk sync succeeds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of REST requests answered 503')
+    parser.add_argument('--stream', action='store_true', help='stream the Bulk export into the database')
+    parser.add_argument('--fast-load', action='store_true', help='load with WAL and a staging table')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the syncs')
+    args = parser.parse_args()
+
+    mock = MockEloqua(records=args.records, width=args.width, campaigns=args.campaigns, external=args.external,
+                      latency=args.latency, sync_delay=args.sync_delay, error_rate=args.error_rate)
+    options = {'table': args.table, 'stream': args.stream, 'fast_load': args.fast_load, 'verbose': args.verbose}
+
+    results = run(args.scenarios, mock, options)
+
+    if args.json:
+        with open(args.json, 'w') as fopen:
+            json.dump(results, fopen, indent=3)
+
+
+if __name__ == '__main__':
+    main()
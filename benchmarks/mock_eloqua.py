@@ -0,0 +1,533 @@
+#!/usr/bin/python
+# Mock Eloqua server by Greg Bernard
+
+"""
+A local stand-in for the parts of Eloqua used by pyeloqua's Bulk class and by ElqRest:
+the login/id endpoint, Bulk fields, export definitions, syncs and paged export data,
+and the REST external activity, campaign and user assets.
+Records are generated on request from their position, so any volume can be served in constant memory.
+
+Start it on its own with: python benchmarks/mock_eloqua.py --records 100000 --port 8080
+Then call patch_login('http://127.0.0.1:8080') in the process that logs in, so requests to
+https://login.eloqua.com are sent to the mock server instead.
+"""
+
+import re
+import json
+import time
+import random
+import datetime
+import argparse
+import threading
+import collections
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+LOGIN_URL = 'https://login.eloqua.com'
+
+# Every generated record is one STEP after the previous one, starting at EPOCH
+EPOCH = datetime.datetime(2017, 1, 1)
+STEP = datetime.timedelta(minutes=1)
+
+CONTACT_FIELDS = [('C_EmailAddress', 'Email Address', 'emailAddress'),
+                  ('C_FirstName', 'First Name', 'string'),
+                  ('C_LastName', 'Last Name', 'string'),
+                  ('C_Company', 'Company', 'string'),
+                  ('C_Country', 'Country', 'string'),
+                  ('C_Lead_Score', 'Lead Score', 'number'),
+                  ('C_DateCreated', 'Date Created', 'date'),
+                  ('C_DateModified', 'Date Modified', 'date')]
+
+ACCOUNT_FIELDS = [('M_CompanyName', 'Company Name', 'string'),
+                  ('M_Country', 'Country', 'string'),
+                  ('M_Annual_Revenue', 'Annual Revenue', 'number'),
+                  ('M_DateCreated', 'Date Created', 'date')]
+
+
+class MockEloqua(object):
+    """
+    Serves synthetic Eloqua data over HTTP on a background thread, and counts the API calls it receives
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param records: number of records in every Bulk table
+        :param width: number of extra custom fields on contacts and accounts
+        :param campaigns: number of campaigns
+        :param users: number of users
+        :param external: number of external activities
+        :param deleted: fraction of external activity ids that were deleted and answer 404
+        :param latency: seconds added to every response
+        :param sync_delay: seconds a sync stays active before it succeeds
+        :param error_rate: fraction of REST requests answered 503 with a Retry-After header
+        :param port: port to listen on, 0 picks a free one
+        """
+
+        self.records = kwargs.get('records', 100000)
+        self.width = kwargs.get('width', 20)
+        self.campaigns = kwargs.get('campaigns', 2000)
+        self.users = kwargs.get('users', 200)
+        self.external = kwargs.get('external', 500)
+        self.deleted = kwargs.get('deleted', 0.0)
+        self.latency = kwargs.get('latency', 0.0)
+        self.sync_delay = kwargs.get('sync_delay', 0.0)
+        self.error_rate = kwargs.get('error_rate', 0.0)
+        self.port = kwargs.get('port', 0)
+
+        self.calls = collections.Counter()
+        self.definitions = {}
+        self.definitions_created = 0
+        self.syncs = {}
+        self.updated = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        """
+        Start serving on a daemon thread
+        :return: base url of the server
+        """
+
+        mock = self
+
+        class Handler(EloquaHandler):
+            server_mock = mock
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MockEloqua', daemon=True)
+        self.thread.start()
+
+        return self.base_url
+
+    def stop(self):
+        """
+        Stop the server
+        """
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] += 1
+            self.calls['total'] += 1
+
+    def fail(self):
+        """
+        True if this request should fail, counted as an error call
+        """
+
+        if not self.error_rate:
+            return False
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+        if failed:
+            self.count('errors')
+        return failed
+
+    # ------------------------------------------------------------------------------------------
+    # Bulk API
+    # ------------------------------------------------------------------------------------------
+
+    def fields(self, elq_object):
+        """
+        Custom fields of contacts or accounts, the system fields are added by pyeloqua
+        """
+
+        if elq_object == 'contacts':
+            fields, entity = list(CONTACT_FIELDS), 'Contact'
+        else:
+            fields, entity = list(ACCOUNT_FIELDS), 'Account'
+
+        fields += [('{}_Field{}'.format(fields[0][0][0], i), 'Field {}'.format(i), 'number' if i % 4 == 0 else 'string')
+                   for i in range(self.width)]
+
+        return [{'type': 'ContactField', 'id': str(i + 1), 'name': name, 'internalName': internal,
+                 'dataType': data_type, 'hasReadOnlyConstraint': False, 'hasNotNullConstraint': False,
+                 'hasUniquenessConstraint': False, 'uri': '/{}/fields/{}'.format(elq_object, i + 1),
+                 'statement': '{{{{{}.Field({})}}}}'.format(entity, internal)}
+                for i, (internal, name, data_type) in enumerate(fields)]
+
+    def create_definition(self, elq_object, body):
+        """
+        Register an export definition
+        """
+
+        with self.lock:
+            # Deleted definitions leave gaps, ids are never reused
+            self.definitions_created += 1
+            def_id = self.definitions_created
+            uri = '/{}/exports/{}'.format(elq_object, def_id)
+            self.definitions[uri] = {'fields': body.get('fields', {}), 'filter': body.get('filter', '')}
+
+        return {'name': body.get('name'), 'fields': body.get('fields', {}), 'filter': body.get('filter'),
+                'dataRetentionDuration': 'PT12H', 'uri': uri, 'createdAt': _timestamp_(datetime.datetime.now())}
+
+    def update_definition(self, uri, body):
+        """
+        Replace the fields and filter of an export definition
+        """
+
+        with self.lock:
+            self.definitions[uri] = {'fields': body.get('fields', {}), 'filter': body.get('filter', '')}
+
+        return {'name': body.get('name'), 'fields': body.get('fields', {}), 'filter': body.get('filter'),
+                'dataRetentionDuration': 'PT12H', 'uri': uri}
+
+    def create_sync(self, body):
+        """
+        Start a sync of an export definition
+        """
+
+        with self.lock:
+            sync_id = len(self.syncs) + 1
+            uri = '/syncs/{}'.format(sync_id)
+            self.syncs[uri] = {'def_uri': body['syncedInstanceUri'], 'created': time.time()}
+
+        return {'syncedInstanceUri': body['syncedInstanceUri'], 'status': 'pending', 'uri': uri,
+                'createdAt': _timestamp_(datetime.datetime.now())}
+
+    def sync_status(self, uri):
+        sync = self.syncs[uri]
+        status = 'success' if time.time() - sync['created'] >= self.sync_delay else 'active'
+
+        return {'syncedInstanceUri': sync['def_uri'], 'status': status, 'uri': uri}
+
+    def export_data(self, def_uri, offset, limit):
+        """
+        One page of the records selected by an export definition
+        """
+
+        definition = self.definitions[def_uri]
+        first, last = self._window_(definition['filter'])
+        activity = re.search(r"\{\{Activity\.Type\}\}' = '(\w+)'", definition['filter'] or '')
+        activity = activity.group(1) if activity else None
+
+        total = max(last - first, 0)
+        limit = min(limit, 50000)
+        positions = range(first + offset, min(first + offset + limit, last))
+        items = [self._record_(definition['fields'], i, activity) for i in positions]
+
+        page = {'totalResults': total, 'limit': limit, 'offset': offset, 'count': len(items),
+                'hasMore': offset + len(items) < total}
+        if len(items) != 0:
+            page['items'] = items
+
+        return page
+
+    def _window_(self, filters):
+        """
+        Positions of the records within the date filter of a definition
+        """
+
+        first, last = 0, self.records
+        for operator, value in re.findall(r"'\{\{[^}]+\}\}' (>=|<=|<) '([^']+)'", filters or ''):
+            delta = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S') - EPOCH
+            if operator == '>=':
+                first = max(first, -(-delta // STEP))
+            elif operator == '<':
+                last = min(last, -(-delta // STEP))
+            else:
+                last = min(last, delta // STEP + 1)
+
+        return max(first, 0), max(last, 0)
+
+    @staticmethod
+    def _record_(fields, i, activity):
+        """
+        Synthetic record at position i, with a value for every field of the definition
+        """
+
+        record = {}
+        for key, statement in fields.items():
+            if statement in ('{{Contact.Id}}', '{{Account.Id}}', '{{Activity.Id}}'):
+                value = str(i + 1)
+            elif 'CreatedAt' in statement or 'UpdatedAt' in statement or 'Date' in key:
+                value = _timestamp_(EPOCH + i * STEP)
+            elif statement == '{{Activity.Type}}':
+                value = activity
+            elif 'IpAddress' in key:
+                value = '{}.{}.{}.{}'.format(24 + i % 200, i // 65536 % 256, i // 256 % 256, i % 256)
+            elif 'ContactId' in key or 'Contact.Id' in statement:
+                value = str(i % 5000 + 1)
+            elif 'Email' in key:
+                value = 'user{}@example.com'.format(i % 5000)
+            elif 'Score' in key or 'Revenue' in key or 'Id' in key:
+                value = str(i % 1000)
+            else:
+                value = '{} {}'.format(key, i % 100)
+            record[key] = value
+
+        return record
+
+    # ------------------------------------------------------------------------------------------
+    # REST API
+    # ------------------------------------------------------------------------------------------
+
+    def external_activity(self, activity_id):
+        """
+        External activity by id, None past the last one or if it was deleted
+        """
+
+        if not 1 <= activity_id <= self.external:
+            return None
+        if self.deleted and random.Random(activity_id).random() < self.deleted:
+            return None
+
+        return {'type': 'Activity', 'id': str(activity_id), 'depth': 'complete',
+                'name': 'External Activity {}'.format(activity_id),
+                'activityDate': str(_unix_(EPOCH + activity_id * STEP)), 'activityType': 'Webinar',
+                'assetName': 'Webinar {}'.format(activity_id % 20), 'assetType': 'Event',
+                'campaignId': str(activity_id % self.campaigns + 1), 'contactId': str(activity_id % 5000 + 1)}
+
+    def touch(self, kind, ids):
+        """
+        Mark campaigns or users as updated now
+        :param kind: campaign or user
+        :param ids: ids of the updated assets
+        """
+
+        for i in ids:
+            self.updated[(kind, i)] = int(time.time())
+
+    def campaign_page(self, page, count, search=None):
+        ids = [i for i in range(1, self.campaigns + 1) if _matches_(search, self._updated_at_('campaign', i))]
+        elements = [self._campaign_(i) for i in ids[(page - 1) * count:page * count]]
+        return {'elements': elements, 'page': page, 'pageSize': count, 'total': len(ids)}
+
+    def user_page(self, page, count, search=None):
+        ids = [i for i in range(1, self.users + 1) if _matches_(search, self._updated_at_('user', i))]
+        elements = [self._user_(i) for i in ids[(page - 1) * count:page * count]]
+        return {'elements': elements, 'page': page, 'pageSize': count, 'total': len(ids)}
+
+    def _updated_at_(self, kind, i):
+        return self.updated.get((kind, i), _unix_(EPOCH + i * STEP))
+
+    def _campaign_(self, i):
+        date = str(_unix_(EPOCH + i * STEP))
+        return {'type': 'Campaign', 'currentStatus': 'Active', 'id': str(i), 'createdAt': date, 'createdBy': '1',
+                'depth': 'partial', 'name': 'Campaign {}'.format(i),
+                'updatedAt': str(self._updated_at_('campaign', i)), 'updatedBy': '1',
+                'actualCost': str(i % 500), 'budgetedCost': '1000', 'product': 'Product {}'.format(i % 5),
+                'region': 'Region {}'.format(i % 3), 'campaignCategory': 'emailMarketing',
+                'fieldValues': [{'type': 'FieldValue', 'id': str(n), 'value': 'Value {}'.format(n)} for n in (1, 2, 3)],
+                'firstActivation': date, 'memberCount': str(i % 250), 'startAt': date, 'endAt': date}
+
+    def _user_(self, i):
+        date = str(_unix_(EPOCH + i * STEP))
+        return {'type': 'User', 'id': str(i), 'createdAt': date, 'createdBy': '1', 'depth': 'complete',
+                'description': '', 'name': 'User {}'.format(i), 'updatedAt': str(self._updated_at_('user', i)),
+                'updatedBy': '1',
+                'company': 'Company', 'emailAddress': 'user{}@example.com'.format(i), 'loginName': 'user{}'.format(i)}
+
+
+class EloquaHandler(BaseHTTPRequestHandler):
+    """
+    Routes requests to the MockEloqua instance in server_mock
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would hold the body back on a kept-alive connection
+    disable_nagle_algorithm = True
+    server_mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply_(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body_(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _route_(self, method):
+        mock = self.server_mock
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        url = urlsplit(self.path)
+        path = re.sub('/+', '/', url.path).rstrip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 1000))
+
+        bulk = re.match(r'/API/Bulk/[\d.]+(/.*)', path, re.IGNORECASE)
+        rest = re.match(r'/API/REST/[\d.]+(/.*)', path, re.IGNORECASE)
+
+        if path == '/id':
+            mock.count('login')
+            base = mock.base_url
+            return self._reply_(200, {'site': {'id': 1, 'name': 'MockCompany'},
+                                      'user': {'id': 1, 'username': 'mock', 'displayName': 'Mock User'},
+                                      'urls': {'base': base,
+                                               'apis': {'rest': {'standard': base + '/API/REST/{version}/',
+                                                                 'bulk': base + '/API/Bulk/{version}/'}}}})
+        if bulk:
+            return self._bulk_(method, bulk.group(1), offset, limit)
+        if rest and method == 'GET':
+            if mock.fail():
+                return self._reply_(503, headers={'Retry-After': '0'})
+            return self._rest_(rest.group(1), query)
+
+        return self._reply_(404, {'error': 'Unknown endpoint {}'.format(path)})
+
+    def _bulk_(self, method, path, offset, limit):
+        mock = self.server_mock
+
+        fields = re.fullmatch(r'/(contacts|accounts)/fields', path)
+        exports = re.fullmatch(r'/(contacts|accounts|activities)/exports', path)
+        definition = re.fullmatch(r'(/(?:contacts|accounts|activities)/exports/\d+)(/data)?', path)
+        sync = re.fullmatch(r'(/syncs/\d+)(/data)?', path)
+
+        if fields and method == 'GET':
+            mock.count('fields')
+            items = mock.fields(fields.group(1))
+            return self._reply_(200, {'items': items[offset * limit:(offset + 1) * limit], 'totalResults': len(items),
+                                      'limit': limit, 'offset': offset, 'count': len(items), 'hasMore': False})
+        if exports and method == 'POST':
+            mock.count('definitions')
+            return self._reply_(201, mock.create_definition(exports.group(1), self._body_()))
+        if definition and definition.group(1) not in mock.definitions:
+            return self._reply_(404, {'error': 'Definition not found'})
+        if definition and method == 'DELETE':
+            mock.count('definition_deletes')
+            with mock.lock:
+                del mock.definitions[definition.group(1)]
+            return self._reply_(204)
+        if definition and not definition.group(2) and method == 'PUT':
+            mock.count('definition_updates')
+            return self._reply_(200, mock.update_definition(definition.group(1), self._body_()))
+        if definition and definition.group(2) and method == 'GET':
+            mock.count('data')
+            return self._reply_(200, mock.export_data(definition.group(1), offset, limit))
+        if path == '/syncs' and method == 'POST':
+            mock.count('syncs')
+            return self._reply_(201, mock.create_sync(self._body_()))
+        if sync and sync.group(1) not in mock.syncs:
+            return self._reply_(404, {'error': 'Sync not found'})
+        if sync and sync.group(2) and method == 'GET':
+            mock.count('data')
+            return self._reply_(200, mock.export_data(mock.syncs[sync.group(1)]['def_uri'], offset, limit))
+        if sync and method == 'GET':
+            mock.count('syncs')
+            return self._reply_(200, mock.sync_status(sync.group(1)))
+
+        return self._reply_(404, {'error': 'Unknown Bulk endpoint {}'.format(path)})
+
+    def _rest_(self, path, query):
+        mock = self.server_mock
+        mock.count('rest')
+
+        page = int(query.get('page', 1))
+        count = int(query.get('count', 1000))
+
+        activity = re.fullmatch(r'/data/activity/(\d+)', path)
+        if activity:
+            record = mock.external_activity(int(activity.group(1)))
+            return self._reply_(200, record) if record else self._reply_(404)
+        if path == '/assets/campaigns':
+            return self._reply_(200, mock.campaign_page(page, count, query.get('search')))
+        if path == '/system/users':
+            return self._reply_(200, mock.user_page(page, count, query.get('search')))
+
+        return self._reply_(404, {'error': 'Unknown REST endpoint {}'.format(path)})
+
+    def do_GET(self):
+        self._route_('GET')
+
+    def do_POST(self):
+        self._route_('POST')
+
+    def do_PUT(self):
+        self._route_('PUT')
+
+    def do_DELETE(self):
+        self._route_('DELETE')
+
+
+def patch_login(base_url):
+    """
+    Send every request for https://login.eloqua.com to the mock server instead,
+    the login url is fixed in pyeloqua and ElqRest
+    """
+
+    request = requests.Session.request
+
+    def redirect(self, method, url, *args, **kwargs):
+        if url.startswith(LOGIN_URL):
+            url = base_url + url[len(LOGIN_URL):]
+        return request(self, method, url, *args, **kwargs)
+
+    requests.Session.request = redirect
+
+
+def _timestamp_(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S.') + '{:03d}'.format(value.microsecond // 1000)
+
+
+def _unix_(value):
+    return int(time.mktime(value.timetuple()))
+
+
+def _matches_(search, updated):
+    """
+    True if an asset updated at the given unix time matches a search on updatedAt, e.g. updatedAt>=1500000000
+    """
+
+    if not search:
+        return True
+
+    match = re.fullmatch(r"updatedAt\s*(>=|<=|>|<|=)\s*'?(\d+)'?", search)
+    if match is None:
+        return True
+
+    value = int(match.group(2))
+    return {'>=': updated >= value, '<=': updated <= value, '>': updated > value,
+            '<': updated < value, '=': updated == value}[match.group(1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--records', type=int, default=100000, help='records in every Bulk table')
+    parser.add_argument('--campaigns', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--external', type=int, default=500, help='number of external activities')
+    parser.add_argument('--deleted', type=float, default=0.0, help='fraction of external activities deleted')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--sync-delay', type=float, default=0.0, help='seconds before a sync succeeds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of REST requests answered 503')
+    args = parser.parse_args()
+
+    mock = MockEloqua(records=args.records, campaigns=args.campaigns, users=args.users, external=args.external,
+                      deleted=args.deleted, latency=args.latency, sync_delay=args.sync_delay,
+                      error_rate=args.error_rate, port=args.port)
+    print("Mock Eloqua listening on {}".format(mock.start()))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# Budget by Greg Bernard
+
+import time
+import atexit
+import sqlite3
+import datetime
+import threading
+
+# Defaults of the shared budget, set these before the first sync of the process
+RATE = None  # API calls per second, None does not limit the rate
+BURST = 20  # calls that can be made at once after a quiet period
+DAILY_QUOTA = None  # API calls per day for the whole instance, e.g. your Eloqua daily limit, None is unlimited
+BUDGET_FILE = 'eloqua_budget.db'  # calls used today, shared by every process on the machine
+LEASE = 25  # calls taken from the daily quota at a time, unused calls are given back when the process ends
+
+# Lower values go first, a job waiting for a call is served before any job of a lower priority
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+# Share of the daily quota kept back for higher priorities: low priority jobs stop once less than 30% is left,
+# normal priority jobs once less than 10% is left, high priority jobs can use all of it
+RESERVES = {'high': 0.0, 'normal': 0.1, 'low': 0.3}
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class BudgetExhausted(Exception):
+    """
+    Raised when a job's share of the daily API quota is used up
+    """
+    pass
+
+
+class Budget(object):
+    """
+    Rate limit and daily quota for Eloqua API calls, shared by every job in the process.
+    Calls are handed out by a token bucket, and a job of higher priority waiting for a call is always served first.
+    The calls used each day are recorded in a small SQLite file, so separate processes share the same quota.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param rate: API calls per second, None does not limit the rate
+        :param burst: calls that can be made at once after a quiet period
+        :param daily_quota: API calls per day, None is unlimited
+        :param filename: SQLite file recording the calls used each day
+        :param lease: calls taken from the daily quota at a time
+        :param reserves: dictionary of priority: share of the daily quota kept back for higher priorities
+        """
+
+        self.rate = kwargs.get('rate', RATE)
+        self.burst = kwargs.get('burst', BURST)
+        self.daily_quota = kwargs.get('daily_quota', DAILY_QUOTA)
+        self.filename = kwargs.get('filename', BUDGET_FILE)
+        self.lease = kwargs.get('lease', LEASE)
+        self.reserves = kwargs.get('reserves', RESERVES)
+
+        self.condition = threading.Condition()
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.waiting = {level: 0 for level in PRIORITIES.values()}
+
+        # Calls taken from today's quota and not spent yet, by priority
+        self.day = None
+        self.leased = {}
+        self.spent = 0
+
+    def spend(self, priority='normal', calls=1):
+        """
+        Wait until the rate limit allows another call, then take it from the daily quota
+        :param priority: high, normal or low
+        :param calls: number of calls about to be made
+        :raise BudgetExhausted: if the quota left for this priority is used up
+        """
+
+        level = PRIORITIES[priority]
+
+        for _ in range(calls):
+            self._take_quota_(priority)
+            if self.rate is not None:
+                self._take_token_(level)
+
+        with self.condition:
+            self.spent += calls
+
+    def _take_token_(self, level):
+        """
+        Block until a token is free and no job of a higher priority is waiting for one
+        """
+
+        with self.condition:
+            self.waiting[level] += 1
+            try:
+                while True:
+                    self._refill_()
+                    ahead = any(self.waiting[other] for other in self.waiting if other < level)
+                    if self.tokens >= 1 and not ahead:
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(max((1 - self.tokens) / self.rate, 0.01))
+            finally:
+                self.waiting[level] -= 1
+                self.condition.notify_all()
+
+    def _refill_(self):
+        """
+        Add the tokens earned since the last refill
+        """
+
+        moment = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (moment - self.refilled) * self.rate)
+        self.refilled = moment
+
+    def _take_quota_(self, priority):
+        """
+        Take one call from the calls leased for this priority, leasing more from the daily quota when they run out
+        """
+
+        if self.daily_quota is None:
+            return
+
+        with self.condition:
+            today = datetime.date.today().isoformat()
+            if self.day != today:
+                # Calls leased yesterday were counted against yesterday's quota
+                self.day = today
+                self.leased = {}
+
+            if self.leased.get(priority, 0) == 0:
+                self.leased[priority] = self._lease_(priority)
+                if self.leased[priority] == 0:
+                    raise BudgetExhausted("The daily API quota left for {} priority jobs is used up.".format(priority))
+
+            self.leased[priority] -= 1
+
+    def _lease_(self, priority):
+        """
+        Take up to lease calls from today's quota in the budget file, leaving the reserve of this priority untouched
+        :return: number of calls taken
+        """
+
+        limit = self.daily_quota - int(self.daily_quota * self.reserves.get(priority, 0.0))
+
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        try:
+            db.execute("""CREATE TABLE IF NOT EXISTS api_budget (day TEXT PRIMARY KEY, used INTEGER)""")
+            db.execute("""BEGIN IMMEDIATE""")
+            row = db.execute("""SELECT used FROM api_budget WHERE day = ?""", (self.day,)).fetchone()
+            used = 0 if row is None else row[0]
+            granted = max(0, min(self.lease, limit - used))
+            db.execute("""INSERT OR REPLACE INTO api_budget (day, used) VALUES (?, ?)""", (self.day, used + granted))
+            db.execute("""COMMIT""")
+        finally:
+            db.close()
+
+        return granted
+
+    def used_today(self):
+        """
+        Calls used today by every process, including the calls leased and not spent yet
+        """
+
+        db = sqlite3.connect(self.filename, timeout=30)
+        try:
+            row = db.execute("""SELECT used FROM api_budget WHERE day = ?""",
+                             (datetime.date.today().isoformat(),)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            db.close()
+
+        return 0 if row is None else row[0]
+
+    def release(self):
+        """
+        Give the calls leased and not spent back to today's quota
+        """
+
+        with self.condition:
+            unused = sum(self.leased.values())
+            self.leased = {}
+
+        if unused == 0 or self.day != datetime.date.today().isoformat():
+            return
+
+        db = sqlite3.connect(self.filename, timeout=30)
+        try:
+            db.execute("""UPDATE api_budget SET used = MAX(0, used - ?) WHERE day = ?""", (unused, self.day))
+            db.commit()
+        finally:
+            db.close()
+
+
+def shared():
+    """
+    Budget shared by every job in the process, created from the module defaults on first use
+    :return: Budget
+    """
+
+    global _shared
+
+    with _shared_lock:
+        if _shared is None:
+            _shared = Budget()
+            atexit.register(_shared.release)
+        return _shared
@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import sqlite3
 import re
+from metrics import RunMetrics
 
 
 class CityAppend:
@@ -14,11 +15,15 @@ class CityAppend:
         self.filename = filename
         self.table = table
         self.db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        self.metrics = RunMetrics('closest_city', table)
         try:
             self.cities = pd.read_pickle("converted_city_data.p")
         except FileNotFoundError:
-            self.cities = self.pull_cities()
-        self.data = self.pull_data()
+            with self.metrics.stage('pull_cities'):
+                self.cities = self.pull_cities()
+            self.metrics.count('api_calls')
+        with self.metrics.stage('read'):
+            self.data = self.pull_data()
 
     def pull_cities(self):
         """
@@ -102,7 +107,8 @@ class CityAppend:
 
         print("-"*50)
         print("Calculating closest city for each IP.")
-        self.data['cc_city'], self.data['cc_country'], self.data['cc_distance_in_km'] = self.haversine()
+        with self.metrics.stage('haversine'):
+            self.data['cc_city'], self.data['cc_country'], self.data['cc_distance_in_km'] = self.haversine()
 
         return self.data
 
@@ -124,7 +130,10 @@ class CityAppend:
                       }
 
         print("Loading to database.")
-        self.data.to_sql(self.table, con=self.db, if_exists='replace', index=False, dtype=data_types)
+        with self.metrics.stage('insert'):
+            self.data.to_sql(self.table, con=self.db, if_exists='replace', index=False, dtype=data_types)
+        self.metrics.count('rows', len(self.data))
+        self.metrics.finish(self.db)
         self.db.commit()
         self.db.close()
 
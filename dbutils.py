@@ -0,0 +1,472 @@
+#!/usr/bin/python
+# Database helpers by Greg Bernard
+
+import sqlite3
+import datetime
+import json
+
+# Columns that get an index automatically when they exist in a synced table
+INDEXED_COLUMNS = ['updatedAt', 'ActivityDate', 'ContactId']
+
+
+# ------------------------------------------------------------------------------------------
+# Type coercion
+# ------------------------------------------------------------------------------------------
+
+def to_int(value):
+    """
+    Convert an exported value to an integer, decimals are kept as floats
+    """
+
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def to_float(value):
+    """
+    Convert an exported value to a float
+    """
+
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def to_datetime(value):
+    """
+    Convert an exported date, e.g. 2017-08-15 10:31:02.350, to a datetime
+    """
+
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def converter_for(declared):
+    """
+    Converter for a declared column type, None for columns that are stored as they are exported
+    """
+
+    declared = declared.upper()
+
+    if declared.startswith('INTEGER') and 'PRIMARY KEY' not in declared:
+        return to_int
+    if declared.startswith('REAL'):
+        return to_float
+    if declared.startswith(('TIMESTAMP', 'DATETIME', 'DATE')):
+        return to_datetime
+
+    return None
+
+
+def batch_converter(columns, col):
+    """
+    Build a function that converts a batch of rows to the declared column types.
+    The converters are looked up once, then each column of the batch is converted as a whole.
+    :param columns: dictionary of column definitions
+    :param col: list of column names, in the same order as the values in each row
+    :return: function taking a list of rows and returning a list of converted rows
+    """
+
+    converters = [(i, converter_for(columns.get(key, 'TEXT'))) for i, key in enumerate(col)]
+    converters = [(i, fn) for i, fn in converters if fn is not None]
+
+    def convert(rows):
+        if len(converters) == 0 or len(rows) == 0:
+            return rows
+        values = [list(c) for c in zip(*rows)]
+        for i, fn in converters:
+            values[i] = list(map(fn, values[i]))
+        return list(zip(*values))
+
+    return convert
+
+
+def _convert_date_(value):
+    """
+    Read DATE columns back as dates, or as datetimes when the value has a time
+    """
+
+    value = value.decode()
+    if len(value) == 10:
+        return datetime.date.fromisoformat(value)
+
+    return datetime.datetime.fromisoformat(value)
+
+
+# Eloqua date fields carry a time, the default DATE converter only accepts yyyy-mm-dd
+sqlite3.register_converter('DATE', _convert_date_)
+
+
+def create_sync_state(db):
+    """
+    Create the sync_state table, which records the high-water mark, the time of the last run,
+    and the number of records loaded for every synced table
+    :param db: sqlite3 connection, cursor or DbWriter
+    """
+
+    db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                    table_name TEXT PRIMARY KEY,
+                    watermark,
+                    last_run TIMESTAMP,
+                    last_run_rows INTEGER,
+                    total_rows INTEGER)""", ())
+
+
+def get_watermark(db, table, timestamp=True):
+    """
+    Return the high-water mark recorded for a table
+    :param db: sqlite3 connection opened with PARSE_COLNAMES
+    :param table: name of the synced table
+    :param timestamp: convert the stored value to a datetime
+    :return: the high-water mark, None if the table has never been synced
+    """
+
+    if timestamp:
+        sql = """SELECT watermark AS "watermark [timestamp]" FROM sync_state WHERE table_name = ?"""
+    else:
+        sql = """SELECT watermark FROM sync_state WHERE table_name = ?"""
+
+    try:
+        row = db.execute(sql, (table,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    if row is None:
+        return None
+
+    return row[0]
+
+
+def update_sync_state(db, table, watermark, rows, run_started):
+    """
+    Record a batch of loaded records in sync_state. Run it on the same connection, before the commit
+    of the data it describes, so the state and the data are committed together.
+    The high-water mark only ever moves forward.
+    :param db: sqlite3 connection, cursor or DbWriter
+    :param table: name of the synced table
+    :param watermark: highest date or id in the batch
+    :param rows: number of records in the batch
+    :param run_started: time the run started, batches from the same run add up in last_run_rows
+    """
+
+    create_sync_state(db)
+
+    db.execute("""INSERT INTO sync_state (table_name, watermark, last_run, last_run_rows, total_rows)
+                  VALUES (?, ?, ?, ?, ?)
+                  ON CONFLICT(table_name) DO UPDATE SET
+                    watermark = CASE WHEN sync_state.watermark IS NULL
+                                       OR excluded.watermark > sync_state.watermark
+                                     THEN excluded.watermark
+                                     ELSE sync_state.watermark END,
+                    last_run_rows = CASE WHEN excluded.last_run = sync_state.last_run
+                                         THEN sync_state.last_run_rows + excluded.last_run_rows
+                                         ELSE excluded.last_run_rows END,
+                    last_run = excluded.last_run,
+                    total_rows = sync_state.total_rows + excluded.total_rows""",
+               (table, watermark, run_started, rows, rows))
+
+
+def create_checkpoints(db):
+    """
+    Create the sync_checkpoint table, which records the Eloqua sync of an export that is being downloaded
+    and how far the download has got, so an interrupted run can pick up where it stopped
+    :param db: sqlite3 connection or cursor
+    """
+
+    db.execute("""CREATE TABLE IF NOT EXISTS sync_checkpoint (
+                    table_name TEXT PRIMARY KEY,
+                    def_uri TEXT,
+                    sync_uri TEXT,
+                    start TEXT,
+                    synced_at TIMESTAMP,
+                    download_offset INTEGER,
+                    committed_batches INTEGER,
+                    latest TIMESTAMP,
+                    updated TIMESTAMP)""", ())
+
+    # Checkpoints recorded before the latest date was kept
+    evolve_schema(db, 'sync_checkpoint', {'latest': 'TIMESTAMP'})
+
+
+def get_checkpoint(db, table):
+    """
+    Return the checkpoint of an unfinished export
+    :param db: sqlite3 connection opened with PARSE_DECLTYPES
+    :param table: name of the synced table
+    :return: dict of the checkpoint columns, None if the table has no unfinished export
+    """
+
+    try:
+        c = db.execute("""SELECT * FROM sync_checkpoint WHERE table_name = ?""", (table,))
+    except sqlite3.OperationalError:
+        return None
+
+    row = c.fetchone()
+    if row is None:
+        return None
+
+    return dict(zip([d[0] for d in c.description], row))
+
+
+def save_checkpoint(db, table, **values):
+    """
+    Record a new checkpoint for a table, replacing the previous one
+    :param db: sqlite3 connection or cursor
+    :param table: name of the synced table
+    :param values: def_uri, sync_uri, start, synced_at, download_offset, committed_batches and latest
+    """
+
+    create_checkpoints(db)
+
+    values['table_name'] = table
+    values['updated'] = now()
+    db.execute("""INSERT OR REPLACE INTO sync_checkpoint ({}) VALUES ({})""".format(
+        ', '.join(values.keys()), ','.join('?' * len(values))), tuple(values.values()))
+
+
+def update_checkpoint(db, table, offset, batches, latest=None):
+    """
+    Move a checkpoint forward to the number of records and batches committed so far
+    :param latest: latest updatedAt or ActivityDate of the records committed so far
+    """
+
+    db.execute("""UPDATE sync_checkpoint SET download_offset = ?, committed_batches = ?, latest = ?, updated = ?
+                  WHERE table_name = ?""", (offset, batches, latest, now(), table))
+
+
+def clear_checkpoint(db, table):
+    """
+    Remove the checkpoint of a table, once its export has been loaded completely or once another export
+    of the table has started: resuming the interrupted one then would write older records over newer ones
+    :param db: sqlite3 connection or cursor
+    """
+
+    try:
+        db.execute("""DELETE FROM sync_checkpoint WHERE table_name = ?""", (table,))
+    except sqlite3.OperationalError:
+        # No table was ever checkpointed
+        pass
+
+
+def create_run_history(db):
+    """
+    Create the run_history table, which holds the summary of every sync run: its timing by stage,
+    and the number of rows, bytes and API calls it took
+    :param db: sqlite3 connection, cursor or DbWriter
+    """
+
+    db.execute("""CREATE TABLE IF NOT EXISTS run_history (
+                    id INTEGER PRIMARY KEY,
+                    job TEXT,
+                    table_name TEXT,
+                    started TIMESTAMP,
+                    finished TIMESTAMP,
+                    status TEXT,
+                    seconds REAL,
+                    rows INTEGER,
+                    bytes INTEGER,
+                    api_calls INTEGER,
+                    stages TEXT)""", ())
+
+
+def record_run(db, summary):
+    """
+    Record the summary of a run in run_history, see metrics.RunMetrics.summary()
+    :param db: sqlite3 connection, cursor or DbWriter
+    :param summary: dict with job, table, started, finished, status, seconds, stages and counters
+    """
+
+    create_run_history(db)
+
+    counters = summary['counters']
+    db.execute("""INSERT INTO run_history (job, table_name, started, finished, status, seconds,
+                                           rows, bytes, api_calls, stages)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+               (summary['job'], summary['table'], summary['started'], summary['finished'], summary['status'],
+                summary['seconds'], counters.get('rows', 0), counters.get('bytes', 0),
+                counters.get('api_calls', 0), json.dumps(summary['stages'])))
+
+
+def create_row_hashes(db):
+    """
+    Create the row_hashes table, which holds a hash of the content of every record loaded by an incremental
+    REST sync, so records that come back unchanged are not written again
+    :param db: sqlite3 connection or cursor
+    """
+
+    db.execute("""CREATE TABLE IF NOT EXISTS row_hashes (
+                    table_name TEXT,
+                    id TEXT,
+                    hash TEXT,
+                    PRIMARY KEY (table_name, id))""", ())
+
+
+def get_row_hashes(db, table):
+    """
+    Return the stored content hashes of a table
+    :param db: sqlite3 connection or cursor
+    :param table: name of the synced table
+    :return: dictionary of id: hash
+    """
+
+    try:
+        return dict(db.execute("""SELECT id, hash FROM row_hashes WHERE table_name = ?""", (table,)).fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+
+def save_row_hashes(db, table, hashes):
+    """
+    Store the content hashes of loaded records. Run it before the commit of the records it describes.
+    :param db: sqlite3 connection or cursor
+    :param table: name of the synced table
+    :param hashes: dictionary of id: hash
+    """
+
+    create_row_hashes(db)
+
+    db.executemany("""INSERT OR REPLACE INTO row_hashes (table_name, id, hash) VALUES (?, ?, ?)""",
+                   [(table, str(key), value) for key, value in hashes.items()])
+
+
+def max_value(records, column):
+    """
+    Highest non-empty value of a column in a list of records
+    :param records: list of dicts
+    :param column: key to look at
+    :return: the highest value, None if there are none
+    """
+
+    values = [d[column] for d in records if d.get(column) not in (None, '')]
+
+    if len(values) == 0:
+        return None
+
+    return max(values)
+
+
+def index_sql(table, columns):
+    """
+    SQL statements that create an index on every column of INDEXED_COLUMNS present in the table
+    :param table: name of the table
+    :param columns: dictionary of column definitions, or list of column names
+    """
+
+    return ["""CREATE INDEX IF NOT EXISTS "idx_{t}_{c}" ON {t} ('{c}')""".format(t=table, c=col)
+            for col in INDEXED_COLUMNS if col in columns]
+
+
+def evolve_schema(db, table, columns):
+    """
+    Add every column the table is missing, in place, with ALTER TABLE ... ADD COLUMN.
+    Existing columns and records are left untouched, so new Eloqua fields never force a new table.
+    :param db: sqlite3 connection
+    :param table: name of the table
+    :param columns: dictionary of column definitions the table should have
+    :return: list of the columns that were added
+    """
+
+    existing = [row[1].lower() for row in db.execute("""PRAGMA table_info('{}')""".format(table))]
+
+    added = []
+    for key, value in columns.items():
+        if key.lower() not in existing:
+            # SQLite cannot add a primary key to an existing table, the new column keeps only its type
+            db.execute("""ALTER TABLE {} ADD COLUMN '{}' {}""".format(
+                table, key, value.replace('PRIMARY KEY', '').strip()))
+            added.append(key)
+
+    if len(added) != 0:
+        print("Added new columns to {}: {}".format(table, added))
+
+    return added
+
+
+def tune_for_load(db):
+    """
+    Switch a connection to settings suited to large loads: write-ahead logging, fewer syncs to disk,
+    a large page cache, memory mapped reads and temporary tables kept in memory
+    :param db: sqlite3 connection
+    """
+
+    db.execute("""PRAGMA journal_mode=WAL""")
+    db.execute("""PRAGMA synchronous=NORMAL""")
+    db.execute("""PRAGMA cache_size=-200000""")
+    db.execute("""PRAGMA mmap_size=268435456""")
+    db.execute("""PRAGMA temp_store=MEMORY""")
+
+
+def primary_key(columns):
+    """
+    Name of the primary key column in a dictionary of column definitions, None if there is none
+    """
+
+    for key, value in columns.items():
+        if 'PRIMARY KEY' in value:
+            return key
+
+    return None
+
+
+def upsert_rows(db, table, col, sql_data, key):
+    """
+    Load rows through a temporary staging table, then merge them into the table with a single
+    INSERT ... ON CONFLICT DO UPDATE. Records that already exist are updated in place rather than
+    deleted and reinserted, and records whose values have not changed are not written at all.
+    :param db: sqlite3 connection
+    :param table: name of the table
+    :param col: list of column names, in the same order as the values in each row
+    :param sql_data: list of rows to load
+    :param key: primary key column of the table
+    """
+
+    stage = 'stage_{}'.format(table)
+    columns = ', '.join('"{}"'.format(c) for c in col)
+    update = ', '.join('"{c}" = excluded."{c}"'.format(c=c) for c in col if c != key)
+    changed = ' OR '.join('{t}."{c}" IS NOT excluded."{c}"'.format(t=table, c=c) for c in col if c != key)
+
+    db.execute("""DROP TABLE IF EXISTS temp.{}""".format(stage))
+    db.execute("""CREATE TEMP TABLE {} AS SELECT {} FROM {} WHERE 0""".format(stage, columns, table))
+    db.executemany("""INSERT INTO temp.{} ({}) VALUES ({})""".format(
+        stage, columns, ",".join("?" * len(col))), sql_data)
+
+    if len(update) == 0:
+        db.execute("""INSERT OR IGNORE INTO {t} ({c}) SELECT {c} FROM temp.{s}""".format(
+            t=table, c=columns, s=stage))
+    else:
+        # WHERE true keeps SQLite from reading ON CONFLICT as part of a join
+        db.execute("""INSERT INTO {t} ({c}) SELECT {c} FROM temp.{s} WHERE true
+                      ON CONFLICT("{k}") DO UPDATE SET {u} WHERE {w}""".format(
+                          t=table, c=columns, s=stage, k=key, u=update, w=changed))
+
+    db.execute("""DROP TABLE temp.{}""".format(stage))
+
+
+def missing_column(error):
+    """
+    True if a sqlite3 error was raised because an insert named a column the table does not have
+    """
+    return 'has no column named' in str(error)
+
+
+def now():
+    """
+    Current time, used to mark the start of a run
+    """
+    return datetime.datetime.now()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# DbWriter by Greg Bernard
+
+import sqlite3
+import threading
+import queue
+import time
+import dbutils
+
+
+class DbWriter(threading.Thread):
+    """
+    A single thread that owns the SQLite connection and performs every write for concurrent syncs.
+    Any number of export threads hand it statements through a bounded queue, so only one
+    connection ever writes to the database file and the exports never wait on each other's locks.
+    Writes are grouped in jobs, a table or a window of a table: once a write of a job fails,
+    the rest of that job's writes are skipped, so nothing is recorded for data that was not loaded.
+    """
+
+    def __init__(self, filename='EloquaDB.db', maxsize=8, commit_every=5, fast_load=False):
+        """
+        :param filename: Name of database file
+        :param maxsize: number of pending writes allowed to wait in memory before the exports are paused
+        :param commit_every: number of executemany batches between commits
+        :param fast_load: use WAL and load settings, and accept upsert() batches
+        """
+
+        super(DbWriter, self).__init__(name='DbWriter', daemon=True)
+
+        self.filename = filename
+        self.commit_every = commit_every
+        self.fast_load = fast_load
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.rows = {}
+        self.errors = []
+        self.failed_jobs = set()
+
+    def run(self):
+        """
+        Execute queued statements until close() is called
+        """
+
+        db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        if self.fast_load:
+            dbutils.tune_for_load(db)
+        batches = 0
+
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                break
+
+            # For 'call' items, sql is the function and params its arguments
+            action, table, sql, params, job = item
+            rows = None
+
+            if action == 'wait':
+                params.set()
+                continue
+
+            if job is not None and job in self.failed_jobs and action != 'commit':
+                continue
+
+            try:
+                if action == 'execute':
+                    self._retry_(db.execute, sql, params)
+                elif action == 'executemany':
+                    rows = params
+                    self._retry_(db.executemany, sql, rows)
+                elif action == 'upsert':
+                    col, rows, key = params
+                    self._retry_(dbutils.upsert_rows, db, table, col, rows, key)
+                elif action == 'call':
+                    sql(db, *params)
+                elif action == 'commit':
+                    db.commit()
+            except Exception as e:
+                print("DbWriter: ERROR writing to {}: {}".format(table, e))
+                self.errors.append((table, e))
+                if job is not None:
+                    self.failed_jobs.add(job)
+                continue
+
+            if rows is not None:
+                self.rows[table] = self.rows.get(table, 0) + len(rows)
+                batches += 1
+                if batches % self.commit_every == 0:
+                    db.commit()
+
+        db.commit()
+        db.close()
+
+    @staticmethod
+    def _retry_(method, *args):
+        """
+        Allows a wait period if another application is using the database file, then retries
+        """
+
+        for x in range(1, 6):
+            try:
+                return method(*args)
+            except sqlite3.OperationalError as e:
+                if x == 5 or 'locked' not in str(e):
+                    raise
+                print("DbWriter: {}\n Waiting 15 seconds then trying again.\nTry {} out of 5".format(e, x))
+                time.sleep(15)
+
+    def execute(self, sql, params=(), table=None, job=None):
+        """
+        Queue a single statement
+        """
+        self.queue.put(('execute', table, sql, params, job))
+
+    def executemany(self, sql, rows, table=None, job=None):
+        """
+        Queue a batch of rows for one statement
+        :param job: name the write is grouped under, see failed()
+        """
+        self.queue.put(('executemany', table, sql, rows, job))
+
+    def upsert(self, table, col, rows, key, job=None):
+        """
+        Queue a batch of rows to be merged into the table through a staging table, see dbutils.upsert_rows()
+        """
+        self.queue.put(('upsert', table, None, (col, rows, key), job))
+
+    def call(self, function, *args, **kwargs):
+        """
+        Queue a function to be called with the writer's connection as its first argument,
+        for work that needs to read from the database as well as write to it
+        """
+        self.queue.put(('call', kwargs.get('table'), function, args, kwargs.get('job')))
+
+    def commit(self, table=None):
+        """
+        Queue a commit of everything written so far
+        """
+        self.queue.put(('commit', table, None, None, None))
+
+    def wait(self):
+        """
+        Block until every write queued so far by this thread has been executed
+        """
+
+        done = threading.Event()
+        self.queue.put(('wait', None, None, done, None))
+        done.wait()
+
+    def failed(self, job):
+        """
+        True if a write of the job failed, call wait() first to include everything queued so far
+        """
+        return job in self.failed_jobs
+
+    def retry(self, job):
+        """
+        Accept writes of a failed job again, before it is tried once more
+        """
+        self.failed_jobs.discard(job)
+
+    def close(self):
+        """
+        Finish all queued writes, commit and close the connection
+        """
+        self.queue.put(None)
+        self.join()
+        print("DbWriter: all data has been committed.")
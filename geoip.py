@@ -5,35 +5,135 @@ import sqlite3
 import maxminddb
 import csv
 import time
+import dbutils
+from metrics import RunMetrics
 
 tables_with_ip = ['EmailClickthrough', 'EmailOpen', 'PageView', 'WebVisit']
 
 
-class IpLoc:
+class GeoSession:
+    """
+    Geolocation shared by several IpLoc runs, e.g. every table of full_geoip: the database file and the GeoLite2
+    reader are opened once, and the reader is memory mapped.
+    """
 
     def __init__(self, **kwargs):
+        """
+        :param filename: name of database file
+        :param database: GeoLite2 City database file
+        """
 
-        self.tablename = kwargs.get('tablename', 'EmailClickthrough')
         self.filename = kwargs.get('filename', 'EloquaDB.db')
         self.database = kwargs.get('database', 'GeoLite2-City.mmdb')
 
         self.db = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self.db.row_factory = sqlite3.Row
-        c = self.db.cursor()
 
-        self.reader = maxminddb.open_database(self.database)
+        try:
+            self.reader = maxminddb.open_database(self.database, maxminddb.MODE_MMAP_EXT)
+        except ValueError:
+            # The C extension of maxminddb isn't installed, fall back on the pure Python memory map
+            self.reader = maxminddb.open_database(self.database, maxminddb.MODE_MMAP)
+
+    def close(self):
+        """
+        Close the database file and the GeoLite2 reader, after the last IpLoc run has been committed
+        """
+
+        self.db.close()
+        self.reader.close()
+
+
+class IpLoc:
+
+    def __init__(self, **kwargs):
+        """
+        Reads the IP addresses to locate: distinct addresses found in the rows added to the table since the last run
+        that are not in GeoIP yet
+        :param tablename: activity table to take IP addresses from
+        :param filename: name of database file
+        :param database: GeoLite2 City database file
+        :param full: scan every row of the table again, still skipping addresses already in GeoIP
+        :param session: GeoSession to use the database file and reader of,
+                        filename and database are then ignored
+        """
+
+        self.tablename = kwargs.get('tablename', 'EmailClickthrough')
+        self.filename = kwargs.get('filename', 'EloquaDB.db')
+        self.database = kwargs.get('database', 'GeoLite2-City.mmdb')
+        self.metrics = RunMetrics('geoip', self.tablename)
+        self.run_started = dbutils.now()
+
+        # Rows of the activity table already scanned are recorded in sync_state under this name
+        self.state_name = 'geoip:{}'.format(self.tablename)
+
+        self.session = kwargs.get('session')
+
+        if self.session is None:
+            self.db = sqlite3.connect(self.filename,
+                                      detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            self.db.row_factory = sqlite3.Row
+            self.reader = maxminddb.open_database(self.database)
+        else:
+            self.filename = self.session.filename
+            self.db = self.session.db
+            self.reader = self.session.reader
+
+        c = self.db.cursor()
 
         try:
-            sql_data = c.execute('SELECT IpAddress FROM {}'.format(self.tablename))
-            self.raw_ip_data = sql_data.fetchall()
+            with self.metrics.stage('read'):
+                self.last_row, first_row = self._rows_to_scan_(kwargs.get('full', False))
+                sql_data = c.execute(self._new_ip_sql_(), (first_row, self.last_row))
+                self.raw_ip_data = sql_data.fetchall()
         except sqlite3.OperationalError:
             print("ERROR: There is no IpAddress column in this table.")
             exit()
 
-        self.geo_data = self.ip_data()
-        self.new_data = self.process_step()
+        print("{} new IP addresses found in {}.".format(len(self.raw_ip_data), self.tablename))
+
+        with self.metrics.stage('lookup'):
+            self.geo_data = self.ip_data()
+        self.metrics.count('lookups', len(self.raw_ip_data))
+        with self.metrics.stage('process'):
+            self.new_data = self.process_step()
         self.columns = self._create_db_columns_def_()
 
+    def _rows_to_scan_(self, full=False):
+        """
+        Range of rowids added to the activity table since the last run
+        :param full: scan the whole table
+        :return: (last rowid, rowid the scan starts after)
+        """
+
+        last_row = self.db.execute('SELECT MAX(rowid) FROM {}'.format(self.tablename)).fetchone()[0] or 0
+
+        scanned = None if full else dbutils.get_watermark(self.db, self.state_name, timestamp=False)
+        if scanned is not None and scanned > last_row:
+            # The table was emptied and synced again since, the recorded rowid only ever moves forward
+            self.db.execute("""UPDATE sync_state SET watermark = NULL WHERE table_name = ?""", (self.state_name,))
+            scanned = None
+
+        if scanned is None:
+            scanned = 0
+        elif scanned > 0:
+            print("Scanning the rows of {} added since the last run.".format(self.tablename))
+
+        return last_row, scanned
+
+    def _new_ip_sql_(self):
+        """
+        Query for the distinct IP addresses in a range of rowids that are not in GeoIP yet
+        """
+
+        sql = """SELECT DISTINCT IpAddress FROM {} WHERE rowid > ? AND rowid <= ?
+                 AND IpAddress IS NOT NULL AND IpAddress != ''""".format(self.tablename)
+
+        if self.db.execute("""SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'GeoIP'""").fetchone():
+            sql += """ AND IpAddress NOT IN (SELECT IpAddress FROM GeoIP)"""
+
+        return sql
+
     def ip_data(self):
         """
         Get available location information for provided IP Addresses in SQlite Row format
@@ -78,10 +178,6 @@ class IpLoc:
                     foo_dict.update({k: v['names']['en']})
                     new_data.append(foo_dict)
 
-        print("-"*50)
-        print("Last record:")
-        print(new_data[-1])
-        print("-"*50)
         return new_data
 
     def _create_db_columns_def_(self):
@@ -91,6 +187,9 @@ class IpLoc:
         """
 
         columns = {}
+        if len(self.new_data) == 0:
+            return columns
+
         first_dict = self.new_data[0]
 
         for key, value in first_dict.items():
@@ -113,18 +212,28 @@ class IpLoc:
         Creates a new table in the database to sync IP geolocation data to.
         """
 
+        if len(self.columns) == 0:
+            # Nothing new to locate, the table is created by the first run that finds something
+            return
+
         col = ', '.join("'{}' {}".format(key, val) for key, val in self.columns.items())
 
         print("Creating GeoIP a table if one doesn't exist yet.")
 
         self.db.execute('''CREATE TABLE IF NOT EXISTS GeoIP
                         ({})'''.format(col))
+        dbutils.evolve_schema(self.db, 'GeoIP', self.columns)
 
     def save_location_data(self):
         """
-        Save location data to local database
+        Save location data to local database, and record the rows of the activity table scanned
         """
 
+        if len(self.new_data) == 0:
+            print("No new IP addresses to locate in {}.".format(self.tablename))
+            self._record_scan_(0)
+            return
+
         try:
             col = list(self.new_data[0].keys())
             table_col = ', '.join("'{}'".format(key) for key in col)
@@ -146,21 +255,24 @@ class IpLoc:
                 except AttributeError:
                     print('ERROR: You must create a table before loading to it. Try initiate_table().')
                 except sqlite3.OperationalError as e:
-                    if x == 5:
-                        print("Renaming GeoIP to GeoIP_old and creating new table to continue sync.")
-                        self.db.execute("""ALTER TABLE GeoIP RENAME TO GeoIP_old;""")
-
-                        n_col = ', '.join("'{}' {}".format(key, val) for key, val in self.columns.items())
-
-                        self.db.execute('''CREATE TABLE IF NOT EXISTS GeoIP
-                                                    ({})'''.format(n_col))
-                        insert_data()
+                    if dbutils.missing_column(e) and x == 1:
+                        # Add the missing columns to GeoIP in place, then try once more
+                        columns = dict(self.columns)
+                        columns.update({key: 'TEXT' for key in col if key not in columns})
+                        dbutils.evolve_schema(self.db, 'GeoIP', columns)
+                        insert_data(x + 1)
+                    elif x == 5:
+                        print("ERROR: {}\n Could not load data into GeoIP after 5 tries.".format(e))
+                        raise
                     else:
                         print("ERROR: {}\n Waiting 15 seconds then trying again.\nTry {} out of 5".format(e, x))
                         time.sleep(15)
                         insert_data(x + 1)
 
-            insert_data()
+            with self.metrics.stage('insert'):
+                insert_data()
+            self.metrics.count('rows', len(sql_data))
+            self._record_scan_(len(self.geo_data))
 
             print("Table has been populated, commit to finalize operation.")
 
@@ -169,13 +281,23 @@ class IpLoc:
                   "to grab data from Eloqua before writing to a database.")
             exit()
 
+    def _record_scan_(self, rows):
+        """
+        Record the last rowid scanned in sync_state, committed with the locations found
+        :param rows: number of IP addresses located
+        """
+        dbutils.update_sync_state(self.db, self.state_name, self.last_row, rows, self.run_started)
+
     def commit_and_close(self):
         """
-        Commit all changes to the database
+        Commit all changes to the database, recording the run in run_history.
+        The database file and reader of a GeoSession are left open for the next table.
         """
+        self.metrics.finish(self.db)
         self.db.commit()
-        self.db.close()
-        self.reader.close()
+        if self.session is None:
+            self.db.close()
+            self.reader.close()
         print("Data has been committed.")
 
 
@@ -222,14 +344,14 @@ def main():
 
     # Iterates through all tables with IP addresses and logs the IP with
     # its geolocation in the GeoIP table
+    session = GeoSession()
     for tb in tables_with_ip:
 
-        db = IpLoc(tablename=tb)
-        db.ip_data()
-        db.process_step()
+        db = IpLoc(tablename=tb, session=session)
         db.create_table()
         db.save_location_data()
         db.commit_and_close()
+    session.close()
 
     # Exports GeoIP table inner joined with tables that contain activities
     # with IP addresses in csv format
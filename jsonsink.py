@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# JsonlSink by Greg Bernard
+
+import os
+import gzip
+import json
+
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class JsonlSink(object):
+    """
+    Writes records as newline-delimited JSON, one record per line, as they are handed to it.
+    Nothing is buffered beyond the current line, so memory use does not grow with the size of the export.
+    Files can be compressed with gzip or zstd, and rotated to a new file once they reach a given size.
+    """
+
+    def __init__(self, filename, compression=None, max_bytes=None):
+        """
+        :param filename: name of the file without extension, e.g. bulk_export_EmailOpen
+        :param compression: None, 'gzip' or 'zstd' (zstd requires the zstandard package)
+        :param max_bytes: start a new file once the current one holds this many bytes on disk,
+                          None writes everything to a single file
+        """
+
+        if compression not in EXTENSIONS:
+            raise ValueError("compression must be None, 'gzip' or 'zstd'.")
+
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                print('ERROR: zstandard must be installed to write zstd compressed files.')
+                exit()
+            self.zstd = zstandard.ZstdCompressor()
+
+        self.filename = filename
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.files = []
+        self.records = 0
+
+        self._raw = None
+        self._out = None
+
+    def _path_(self):
+        """
+        Name of the next file, numbered when the output is rotated
+        """
+
+        if self.max_bytes is None:
+            name = self.filename
+        else:
+            name = '{}.{:05d}'.format(self.filename, len(self.files) + 1)
+
+        return name + '.jsonl' + EXTENSIONS[self.compression]
+
+    def _open_(self):
+        """
+        Open the next file for writing
+        """
+
+        path = self._path_()
+        self._raw = open(path, 'wb')
+
+        if self.compression == 'gzip':
+            self._out = gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=self._raw)
+        elif self.compression == 'zstd':
+            self._out = self.zstd.stream_writer(self._raw, closefd=False)
+        else:
+            self._out = self._raw
+
+        self.files.append(path)
+
+    def _close_file_(self):
+        """
+        Flush and close the current file
+        """
+
+        if self._out is None:
+            return
+
+        if self._out is not self._raw:
+            self._out.close()
+        self._raw.close()
+
+        self._raw = None
+        self._out = None
+
+    def write(self, record):
+        """
+        Write a single record as one line, dates and other values JSON cannot hold are written as strings
+        """
+
+        if self._out is None:
+            self._open_()
+
+        self._out.write(json.dumps(record, default=str).encode('utf-8') + b'\n')
+        self.records += 1
+
+        # The size is checked on the underlying file, so it is the compressed size as written so far
+        if self.max_bytes is not None and self._raw.tell() >= self.max_bytes:
+            self._close_file_()
+
+    def write_many(self, records):
+        """
+        Write every record of an iterable
+        :return: number of records written
+        """
+
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+
+        return count
+
+    def close(self):
+        """
+        Finish the current file
+        """
+
+        self._close_file_()
+        print("Wrote {} records to {}.".format(self.records, ', '.join(self.files) or self._path_()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
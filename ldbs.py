@@ -3,8 +3,13 @@
 
 import schedule
 import time
-from ElqBulk import ElqBulk
-from ElqRest import ElqRest
+import datetime
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ElqBulk import ElqBulk, last_sync_date, run_syncs
+from ElqRest import ElqRest, ACTIVITY_WORKERS
+from dbwriter import DbWriter
+import dbutils
 import TableNames
 import geoip
 from closest_city import CityAppend
@@ -19,92 +24,367 @@ def initialise_database(filename='EloquaDB.db'):
         initialise_table(item, filename)
 
 
-def initialise_table(table, filename='ElqData.db'):
+def initialise_table(table, filename='ElqData.db', stream=False, fast_load=False):
     """
     Initialise only the data for a single table
     :param table: the name of the table you're syncing from Eloqua
     :param filename: the name of the file you're dumping the data into
+    :param stream: stream the export into the database in batches instead of loading it all into memory
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
     """
 
     # Only load/update all values for a single table
-    tb = ElqBulk(filename=filename, table=table)
+    tb = ElqBulk(filename=filename, table=table, fast_load=fast_load)
     tb.create_table()
-    tb.get_initial_data()
-    tb.load_to_database()
+    if stream:
+        tb.get_initial_data(stream=True)
+        tb.stream_to_database()
+    else:
+        tb.get_initial_data()
+        tb.load_to_database()
     tb.commit()
     tb.close()
 
 
-def sync_database(filename='EloquaDB.db'):
+def partitioned_initialise_table(table, filename='EloquaDB.db', **kwargs):
+    """
+    Initialise a large table by splitting its history into date windows, exported from Eloqua
+    in parallel and written to the database by a single DbWriter as each window finishes.
+    A window that fails is retried on its own, without restarting the others.
+    :param table: the name of the table you're syncing from Eloqua
+    :param filename: the name of the file you're dumping the data into
+    :param start: first date of the history to load, format: yyyy-mm-dd
+    :param end: date the history to load stops at, records from that date on are left out, defaults to now
+    :param days: size of each window in days
+    :param workers: number of windows to export at the same time
+    :param retries: number of times a failed window is tried again
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
+    """
+
+    start = kwargs.get('start', '2010-01-01')
+    end = kwargs.get('end', None)
+    days = kwargs.get('days', 30)
+    workers = kwargs.get('workers', 4)
+    retries = kwargs.get('retries', 3)
+    fast_load = kwargs.get('fast_load', False)
+
+    windows = date_windows(start, end, days)
+    run_started = dbutils.now()
+    print("Loading {} in {} windows of {} days.".format(table, len(windows), days))
+
+    writer = DbWriter(filename=filename, fast_load=fast_load)
+    writer.start()
+
+    # An interrupted sequential export of the table would write older records over the windows if it was resumed
+    writer.call(dbutils.clear_checkpoint, table, table=table)
+    writer.commit(table=table)
+
+    # Rows and latest date of every window loaded
+    loaded = []
+
+    attempt = 0
+    while len(windows) != 0 and attempt <= retries:
+        if attempt != 0:
+            print("Retrying {} failed windows, try {} out of {}.".format(len(windows), attempt, retries))
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_export_window_, table, filename, writer, w[0], w[1], run_started): w for w in windows}
+
+            for future in as_completed(futures):
+                w = futures[future]
+                try:
+                    total, latest = future.result()
+                    loaded.append((total, latest))
+                    print("Finished {} window {} to {}, {} records exported.".format(table, w[0], w[1], total))
+                except (Exception, SystemExit) as e:
+                    print("ERROR: {} window {} to {} failed: {}".format(table, w[0], w[1], e))
+                    failed.append(w)
+
+        windows = failed
+        attempt += 1
+
+    # Windows finish in any order, the watermark is only recorded once all of them are in,
+    # so the next sync never starts after a window that could not be loaded
+    if len(windows) == 0:
+        dates = [latest for total, latest in loaded if latest is not None]
+        writer.call(dbutils.update_sync_state, table, max(dates) if len(dates) != 0 else None,
+                    sum(total for total, latest in loaded), run_started, table=table)
+        writer.commit(table=table)
+
+    writer.close()
+
+    if len(windows) != 0:
+        print("ERROR: {} windows of {} could not be loaded: {}".format(len(windows), table, windows))
+        print("ERROR: sync_state was not updated for {}, sync it again once the windows are loaded.".format(table))
+
+
+def date_windows(start, end=None, days=30):
+    """
+    Split the time between start and end into consecutive windows
+    :param start: first date, format: yyyy-mm-dd
+    :param end: last date, format: yyyy-mm-dd, defaults to now
+    :param days: size of each window in days
+    :return: list of (start, end) tuples formatted as yyyy-mm-dd hh:mm:ss, each window's end is the next one's start
+             and is not part of the window
+    """
+
+    fmt = '%Y-%m-%d %H:%M:%S'
+    first = datetime.datetime.strptime(start, '%Y-%m-%d')
+    last = datetime.datetime.strptime(end, '%Y-%m-%d') if end is not None else datetime.datetime.now()
+    step = datetime.timedelta(days=days)
+
+    windows = []
+    while first < last:
+        stop = min(first + step, last)
+        windows.append((first.strftime(fmt), stop.strftime(fmt)))
+        first = stop
+
+    return windows
+
+
+def _export_window_(table, filename, writer, start, end, run_started):
+    """
+    Export one date window of a table from Eloqua and hand its records to the database writer
+    :param table: the name of the table you're syncing from Eloqua
+    :param filename: the name of the file you're dumping the data into
+    :param writer: DbWriter that owns the database connection
+    :param start: first date of the window
+    :param end: end of the window
+    :param run_started: time the partitioned load started, shared by all of its windows
+    :return: (number of records exported, latest date of the window)
+    """
+
+    # The writes of each window are a job of their own, a failed window doesn't stop the others
+    job = '{} {} to {}'.format(table, start, end)
+    writer.retry(job)
+
+    tb = ElqBulk(filename=filename, table=table, connect=False, run_started=run_started,
+                 fast_load=writer.fast_load)
+    writer.call(tb.create_table, table=table, job=job)
+    try:
+        tb.get_initial_data(stream=True, start=start, end=end)
+        return _write_pages_(tb, writer, job, record=False)
+    finally:
+        # Each window has a definition of its own, it is removed from Eloqua once the window is downloaded
+        tb.delete_def()
+
+
+def sync_database(filename='EloquaDB.db', workers=1, fast_load=False):
     """
     Sync entire database in one run
+    :param filename: the name of the file you're dumping the data into
+    :param workers: number of tables to export from Eloqua at the same time,
+                    anything above 1 runs a concurrent sync
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
     """
 
+    if workers > 1:
+        concurrent_sync(TableNames.tables, filename, workers, fast_load)
+        return
+
     for item in TableNames.tables:
-        sync_table(item, filename)
+        sync_table(item, filename, fast_load=fast_load)
 
 
-def sync_table(table, filename='EloquaDB.db'):
+def sync_table(table, filename='EloquaDB.db', stream=False, fast_load=False):
     """
     Sync only the data for a single table
     :param table: the name of the table you're syncing from Eloqua
     :param filename: the name of the file you're dumping the data into
+    :param stream: stream the export into the database in batches instead of loading it all into memory
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
     """
 
     # Only load/update all values for a single table
-    tb = ElqBulk(filename=filename, table=table)
+    tb = ElqBulk(filename=filename, table=table, fast_load=fast_load)
     tb.create_table()
-    tb.get_sync_data()
-    tb.load_to_database()
+    if stream:
+        tb.get_sync_data(stream=True)
+        tb.stream_to_database()
+    else:
+        tb.get_sync_data()
+        tb.load_to_database()
     tb.commit()
     tb.close()
 
 
-def sync_tables(tables, filename='EloquaDB.db'):
+def sync_tables(tables, filename='EloquaDB.db', workers=1, fast_load=False):
     """
     Initialize the data for 1 to many tables
     :param tables: the list of the tables you're syncing from Eloqua
     :param filename: the name of the file you're dumping the data into
+    :param workers: number of tables to export from Eloqua at the same time,
+                    anything above 1 runs a concurrent sync
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
     """
 
     if set(tables).issubset(TableNames.tables) is False:
         print("The inputs must be within the accepted list of Eloqua tables.")
         exit()
 
+    if workers > 1:
+        concurrent_sync(tables, filename, workers, fast_load)
+        return
+
     for item in tables:
-        sync_table(item, filename)
+        sync_table(item, filename, fast_load=fast_load)
+
+
+def concurrent_sync(tables, filename='EloquaDB.db', workers=4, fast_load=False, **kwargs):
+    """
+    Sync several tables at the same time. Every table's sync is submitted to Eloqua up front and polled
+    concurrently, and each table is downloaded as soon as its own sync finishes, see ElqBulk.run_syncs.
+    A single DbWriter thread performs every write to the database file.
+    :param tables: the list of the tables you're syncing from Eloqua
+    :param filename: the name of the file you're dumping the data into
+    :param workers: number of tables to download from Eloqua at the same time
+    :param fast_load: load with WAL, and merge into tables that already hold records through a staging table
+    :param kwargs: timeout, interval, max_interval and backoff of the sync status checks
+    """
+
+    # Read every table's last sync date up front, so the workers never touch the database
+    db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    starts = {}
+    for table in tables:
+        try:
+            starts[table] = last_sync_date(db, table)
+        except sqlite3.OperationalError:
+            starts[table] = None
+    db.close()
+
+    writer = DbWriter(filename=filename, fast_load=fast_load)
+    writer.start()
 
+    results = run_syncs(tables, lambda table: _submit_table_(table, filename, writer, starts[table]),
+                        lambda tb: _load_table_(tb, writer), workers=workers, **kwargs)
 
-def sync_external_activities(filename='EloquaDB.db', start=None, end=99999):
+    for table, (total, error) in results.items():
+        if error is not None:
+            print("ERROR: {} sync failed: {}".format(table, error))
+
+    writer.close()
+
+    failed = [table for table in tables if results[table][1] is not None or writer.failed(table)]
+    if len(failed) != 0:
+        print("ERROR: {} of {} tables failed to sync: {}".format(len(failed), len(tables), ', '.join(failed)))
+
+
+def _submit_table_(table, filename, writer, start):
+    """
+    Submit the Eloqua sync of a single table
+    :param table: the name of the table you're syncing from Eloqua
+    :param filename: the name of the file you're dumping the data into
+    :param writer: DbWriter that owns the database connection
+    :param start: date to extract from, None extracts everything
+    :return: ElqBulk instance with a submitted sync
+    """
+
+    tb = ElqBulk(filename=filename, table=table, connect=False, fast_load=writer.fast_load)
+    writer.call(tb.create_table, table=table, job=table)
+    # Concurrent syncs are never resumed, an interrupted sequential export would write older records over these
+    writer.call(dbutils.clear_checkpoint, table, table=table, job=table)
+    tb.submit_sync(start=start)
+
+    return tb
+
+
+def _load_table_(tb, writer):
+    """
+    Download a table whose sync has finished and hand its records to the database writer
+    :param tb: ElqBulk instance with a finished sync
+    :param writer: DbWriter that owns the database connection
+    :return: number of records exported
+    """
+
+    tb.fetch_export(stream=True)
+    total, latest = _write_pages_(tb, writer)
+    print("Finished {} sync, {} records exported.".format(tb.table, total))
+
+    return total
+
+
+def _write_pages_(tb, writer, job=None, record=True):
+    """
+    Hand every page of a prepared export to the database writer
+    :param tb: ElqBulk instance with a finished export
+    :param writer: DbWriter that owns the database connection
+    :param job: name the writes are grouped under in the writer, defaults to the table
+    :param record: record the export in sync_state once every page is written,
+                   False leaves it to the caller, e.g. once every window of a partitioned load is in
+    :return: (number of records exported, latest date of the export)
+    :raise Exception: if a page could not be written, nothing is then recorded in sync_state
+    """
+
+    if job is None:
+        job = tb.table
+
+    # create_table() has to have run in the writer before tb.upsert() can tell whether the table was empty
+    writer.wait()
+
+    total = 0
+    latest = None
+    for page in tb.metrics.timed(tb.iter_export_data(), 'download'):
+        if len(page) != 0:
+            with tb.metrics.stage('insert'):
+                col, rows = tb.prepare_rows(page)
+                if tb.upsert():
+                    writer.upsert(tb.table, col, rows, tb.key, job=job)
+                else:
+                    writer.executemany(tb.insert_sql(col), rows, table=tb.table, job=job)
+            latest = tb.last_date(page, latest)
+            tb.metrics.count('rows', len(page))
+            total += len(page)
+
+    # Skipped by the writer if a page failed
+    if record:
+        writer.call(dbutils.update_sync_state, tb.table, latest, total, tb.run_started, table=tb.table, job=job)
+
+    writer.commit(table=tb.table)
+    writer.wait()
+
+    if writer.failed(job):
+        tb.metrics.finish(writer, status='error')
+        raise Exception("Could not write every page of {} to the database.".format(job))
+
+    tb.metrics.finish(writer)
+
+    return total, latest
+
+
+def sync_external_activities(filename='EloquaDB.db', start=None, end=99999, workers=ACTIVITY_WORKERS):
     """
     Syncs external activities to the database
     :param filename: the name of the file you're dumping the data into
     :param start: number of the record you wish to start you pull from, defaults to last record created
     :param end: number of the last record you wish to pull, non-inclusive
+    :param workers: number of activities requested from Eloqua at the same time
     """
 
     db = ElqRest(filename=filename, sync='external')
-    db.export_external(start=start, end=end)
+    db.export_external(start=start, end=end, workers=workers)
 
 
-def sync_campaigns(filename='EloquaDB.db'):
+def sync_campaigns(filename='EloquaDB.db', incremental=True):
     """
     Syncs campaigns to the database
     :param filename: the name of the file you're dumping the data into
+    :param incremental: only pull campaigns updated since the last sync, False pulls every campaign
     """
 
     db = ElqRest(filename=filename, sync='campaigns')
-    db.export_campaigns()
+    db.export_campaigns(incremental=incremental)
 
 
-def sync_users(filename='EloquaDB.db'):
+def sync_users(filename='EloquaDB.db', incremental=True):
     """
-    Syncs campaigns to the database
+    Syncs users to the database
     :param filename: the name of the file you're dumping the data into
+    :param incremental: only pull users updated since the last sync, False pulls every user
     """
 
     db = ElqRest(filename=filename, sync='users')
-    db.export_users()
+    db.export_users(incremental=incremental)
 
 
 def full_geoip(**kwargs):
@@ -116,8 +396,13 @@ def full_geoip(**kwargs):
     tables_with_ip = kwargs.get('tables_with_ip', ['EmailClickthrough', 'EmailOpen', 'PageView', 'WebVisit'])
     filename = kwargs.get('filename', 'EloquaDB.db')
 
-    for tb in tables_with_ip:
-        run_geoip(filename=filename, tablename=tb)
+    # One database connection and GeoLite2 reader for every table
+    session = geoip.GeoSession(filename=filename)
+    try:
+        for tb in tables_with_ip:
+            run_geoip(filename=filename, tablename=tb, session=session)
+    finally:
+        session.close()
 
 
 def run_geoip(**kwargs):
@@ -126,11 +411,14 @@ def run_geoip(**kwargs):
     IP Address Geolocations where at least the city was provided
     :param filename: file to sync to
     :param tablename: table to take IP Addresses from to geolocate
+    :param full: scan every row of the table, not only the rows added since the last run
+    :param session: geoip.GeoSession shared with other tables, see full_geoip
     """
-    table = kwargs.get('table','EmailClickthrough')
+    table = kwargs.get('tablename', kwargs.get('table', 'EmailClickthrough'))
     filename = kwargs.get('filename', 'EloquaDB.db')
 
-    db = geoip.IpLoc(filename=filename, tablename=table)
+    db = geoip.IpLoc(filename=filename, tablename=table, full=kwargs.get('full', False),
+                     session=kwargs.get('session'))
     db.create_table()
     db.save_location_data()
     db.commit_and_close()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# RunMetrics by Greg Bernard
+
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+import collections
+import dbutils
+
+# Files the metrics are written to, set either to None to turn it off
+EVENTS_FILE = 'eloqua_metrics.jsonl'
+PROMETHEUS_FILE = 'eloqua_metrics.prom'
+
+# Serialises writes to the metrics files between the threads of a concurrent sync
+_files_lock = threading.Lock()
+
+
+class RunMetrics(object):
+    """
+    Times the stages of a single sync job and counts what it moved: rows, bytes, API calls.
+    Every stage is written as a JSON event as it finishes, and finish() writes a summary event,
+    updates the Prometheus textfile and records the run in the run_history table.
+    """
+
+    def __init__(self, job, table=None, **kwargs):
+        """
+        :param job: kind of sync, e.g. bulk, rest, geoip, closest_city
+        :param table: table the job syncs, the label its metrics are reported under
+        :param events: JSON Lines file for the events, defaults to EVENTS_FILE
+        :param prometheus: Prometheus textfile, defaults to PROMETHEUS_FILE
+        """
+
+        self.job = job
+        self.table = table
+        self.events = kwargs.get('events', EVENTS_FILE)
+        self.prometheus = kwargs.get('prometheus', PROMETHEUS_FILE)
+
+        self.started = dbutils.now()
+        self.clock = time.perf_counter()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.finished = False
+
+    def stage(self, name, event=True):
+        """
+        Time a stage, use as: with metrics.stage('download'): ...
+        A stage that runs several times adds up.
+        :param event: write an event every time the stage finishes, False for stages run once per request
+        """
+        return _Stage(self, name, event)
+
+    def add_time(self, name, seconds, event=True):
+        """
+        Add time spent in a stage
+        """
+
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+        if event:
+            self.event('stage', stage=name, seconds=round(seconds, 6))
+
+    def timed(self, iterable, name):
+        """
+        Iterate over iterable, adding the time spent waiting for each item to a stage
+        """
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start, event=False)
+                self.event('stage', stage=name, seconds=round(self.stages[name], 6))
+                return
+            self.add_time(name, time.perf_counter() - start, event=False)
+            yield item
+
+    def count(self, name, value=1):
+        """
+        Add to a counter, e.g. count('rows', 1000), safe to call from several threads
+        """
+
+        with self.lock:
+            self.counters[name] += value
+
+    def event(self, kind, **fields):
+        """
+        Append a JSON event to the events file
+        """
+
+        if self.events is None:
+            return
+
+        record = collections.OrderedDict([('time', dbutils.now().isoformat()), ('event', kind),
+                                          ('job', self.job), ('table', self.table)])
+        record.update(fields)
+
+        with _files_lock:
+            with open(self.events, 'a') as fopen:
+                fopen.write(json.dumps(record, default=str) + '\n')
+
+    def summary(self, status='success'):
+        """
+        Summary of the run so far
+        """
+
+        with self.lock:
+            return collections.OrderedDict([
+                ('job', self.job), ('table', self.table), ('status', status),
+                ('started', self.started), ('finished', dbutils.now()),
+                ('seconds', round(time.perf_counter() - self.clock, 6)),
+                ('stages', collections.OrderedDict((k, round(v, 6)) for k, v in self.stages.items())),
+                ('counters', dict(self.counters))])
+
+    def finish(self, db=None, status='success'):
+        """
+        Write the summary event and the Prometheus textfile, and record the run in run_history.
+        Only the first call for a run has any effect.
+        :param db: sqlite3 connection, cursor or DbWriter, None skips run_history
+        :param status: outcome of the run, e.g. success or error
+        :return: the summary
+        """
+
+        if self.finished:
+            return None
+        self.finished = True
+
+        summary = self.summary(status)
+        self.event('summary', **{k: v for k, v in summary.items() if k not in ('job', 'table')})
+
+        if self.prometheus is not None:
+            self._write_prometheus_(summary)
+
+        if db is not None:
+            dbutils.record_run(db, summary)
+
+        print("{} {} {} in {:.1f}s: {} rows, {} API calls. Stages: {}".format(
+            self.job, self.table, status, summary['seconds'], self.counters.get('rows', 0),
+            self.counters.get('api_calls', 0),
+            ', '.join('{} {:.1f}s'.format(k, v) for k, v in summary['stages'].items())))
+
+        return summary
+
+    def _write_prometheus_(self, summary):
+        """
+        Update this job and table's samples in the Prometheus textfile, keeping every other job's samples.
+        The file is replaced atomically, as the node_exporter textfile collector expects.
+        """
+
+        labels = 'job="{}",table="{}"'.format(self.job, self.table)
+        samples = collections.OrderedDict()
+
+        samples[('eloqua_sync_duration_seconds', labels)] = summary['seconds']
+        samples[('eloqua_sync_last_run_timestamp_seconds', labels)] = round(time.time(), 3)
+        samples[('eloqua_sync_success', labels)] = 1 if summary['status'] == 'success' else 0
+        for stage, seconds in summary['stages'].items():
+            samples[('eloqua_sync_stage_seconds', labels + ',stage="{}"'.format(stage))] = seconds
+        for name, value in summary['counters'].items():
+            samples[('eloqua_sync_{}'.format(name), labels)] = value
+
+        with _files_lock:
+            existing = _read_prometheus_(self.prometheus)
+            existing = collections.OrderedDict(
+                (key, value) for key, value in existing.items() if not _same_series_(key[1], labels))
+            existing.update(samples)
+
+            lines = []
+            for name in sorted(set(key[0] for key in existing)):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.extend('{}{{{}}} {}'.format(name, label, value)
+                             for (metric, label), value in existing.items() if metric == name)
+
+            directory = os.path.dirname(os.path.abspath(self.prometheus))
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fopen:
+                fopen.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.prometheus)
+
+
+class _Stage(object):
+    """
+    Context manager returned by RunMetrics.stage()
+    """
+
+    def __init__(self, metrics, name, event):
+        self.metrics = metrics
+        self.name = name
+        self.event = event
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start, self.event)
+
+
+def _read_prometheus_(filename):
+    """
+    Samples of a Prometheus textfile written by RunMetrics, keyed by (metric, labels)
+    """
+
+    samples = collections.OrderedDict()
+    try:
+        with open(filename, 'r') as fopen:
+            for line in fopen:
+                match = re.match(r'^(\w+)\{(.*)\} (\S+)$', line.strip())
+                if match:
+                    samples[(match.group(1), match.group(2))] = match.group(3)
+    except IOError:
+        pass
+
+    return samples
+
+
+def _same_series_(labels, job_labels):
+    """
+    True if a sample's labels belong to the given job and table
+    """
+    return labels == job_labels or labels.startswith(job_labels + ',')
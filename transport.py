@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# Transport by Greg Bernard
+
+import time
+import random
+import threading
+import datetime
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+from ElqCache import cache_key
+
+# Defaults for every Transport, change them here or pass them to Transport()
+TIMEOUT = (10, 60)  # seconds to connect, seconds to wait for the response
+RETRIES = 5  # retries after the first attempt
+BACKOFF = 0.5  # seconds before the first retry, doubled after every retry
+MAX_BACKOFF = 60  # longest wait between retries, unless the response asks for longer with Retry-After
+POOL_SIZE = 20  # keep-alive connections kept open per host
+
+# Login discovery, the answer is cached for LOGIN_TTL seconds, see login()
+LOGIN_URL = 'https://login.eloqua.com/id'
+LOGIN_TTL = 86400
+
+# Responses worth trying again: rate limited, or a temporary server side error
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+# One transport per set of credentials, shared by every job in the process
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+class Transport(object):
+    """
+    HTTP session for the Eloqua REST API. Connections are pooled and kept alive between requests,
+    every request has a timeout, and rate limited (429) or failed (5xx) requests are retried
+    with a jittered exponential backoff, waiting as long as the Retry-After header asks.
+    Safe to share between threads.
+    """
+
+    def __init__(self, auth=None, **kwargs):
+        """
+        :param auth: (username, password) sent with every request
+        :param timeout: seconds, or (connect, read) seconds, before a request is abandoned
+        :param retries: number of retries after the first attempt
+        :param backoff: seconds before the first retry
+        :param max_backoff: longest wait between retries
+        :param pool_size: number of keep-alive connections kept open per host
+        """
+
+        self.timeout = kwargs.get('timeout', TIMEOUT)
+        self.retries = kwargs.get('retries', RETRIES)
+        self.backoff = kwargs.get('backoff', BACKOFF)
+        self.max_backoff = kwargs.get('max_backoff', MAX_BACKOFF)
+        pool_size = kwargs.get('pool_size', POOL_SIZE)
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, metrics=None, budget=None, priority='normal', **kwargs):
+        """
+        Send a request, retrying it while Eloqua answers 429 or 5xx or the connection fails
+        :param method: HTTP method, e.g. GET
+        :param url: full url of the request
+        :param metrics: RunMetrics counting every attempt as an API call, and every retry
+        :param budget: budget.Budget every attempt is taken from, None does not limit the calls
+        :param priority: priority of the job in the budget: high, normal or low
+        :param kwargs: passed on to requests, e.g. params, json, headers
+        :return: requests.Response, the last one received if every retry failed
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            if budget is not None:
+                budget.spend(priority)
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if metrics is not None:
+                    metrics.count('api_calls')
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff_(attempt)
+                print("Request failed ({}), retrying in {:.1f}s.".format(e.__class__.__name__, delay))
+            else:
+                if metrics is not None:
+                    metrics.count('api_calls')
+                if resp.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return resp
+                delay = _retry_after_(resp)
+                if delay is None:
+                    delay = self._backoff_(attempt)
+                print("Error Code: {}, retrying in {:.1f}s.".format(resp.status_code, delay))
+
+            if metrics is not None:
+                metrics.count('retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request, see request()
+        """
+        return self.request('GET', url, **kwargs)
+
+    def _backoff_(self, attempt):
+        """
+        Seconds to wait before retry number attempt + 1, with full jitter so that
+        concurrent jobs hitting the same limit do not all retry at once
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def close(self):
+        """
+        Close every pooled connection
+        """
+        self.session.close()
+
+
+def shared(auth):
+    """
+    Transport shared by every job using the same credentials, so they all reuse the same open connections
+    :param auth: (username, password)
+    :return: Transport
+    """
+
+    with _transports_lock:
+        if auth not in _transports:
+            _transports[auth] = Transport(auth=auth)
+        return _transports[auth]
+
+
+def login(company, username, password, cache=None, ttl=LOGIN_TTL, metrics=None, budget=None):
+    """
+    Find the Eloqua instance of a user: its base urls, and the user and site ids.
+    The answer is kept in the cache for ttl seconds, so every job started within that time,
+    in this process or another, skips the login request.
+    :param cache: ElqCache the answer is kept in, None always asks Eloqua
+    :param ttl: seconds a cached answer is used for
+    :param metrics: RunMetrics counting the login request as an API call
+    :param budget: budget.Budget the login request is taken from, at high priority
+    :return: dict as returned by https://login.eloqua.com/id, with keys user, site and urls
+    """
+
+    key = cache_key('login', company, username)
+
+    if cache is not None:
+        found = cache.get(key, ttl=ttl)
+        if found is not None:
+            return found
+
+    req = shared((company + '\\' + username, password)).get(LOGIN_URL, metrics=metrics, budget=budget,
+                                                             priority='high')
+    req.raise_for_status()
+
+    found = req.json()
+    if found == 'Not authenticated.':
+        raise ValueError('Invalid login credentials')
+
+    if cache is not None:
+        cache.set(key, found)
+
+    return found
+
+
+def _retry_after_(resp):
+    """
+    Seconds the Retry-After header of a response asks to wait, None if it has none
+    """
+
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())